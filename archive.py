@@ -0,0 +1,114 @@
+import struct
+import zlib
+
+try:
+    import zstandard
+except ImportError:  # optional, zlib is always available
+    zstandard = None
+
+# A streaming container of (key, payload) records for backups and transfers:
+# a header, then blocks of length-prefixed records. Each block is compressed
+# on its own and carries a crc32, so a reader holds one block at a time and
+# a damaged block is reported instead of silently yielding bad records.
+
+_HEADER = struct.Struct('<4sHBB')  # magic, version, compression, reserved
+_BLOCK = struct.Struct('<IIII')  # stored length, raw length, record count, crc32 of stored bytes
+_RECORD = struct.Struct('<II')  # key length, payload length
+
+MAGIC = b'ABAR'
+VERSION = 1
+BLOCK_SIZE = 1 << 16
+NONE, ZLIB, ZSTD = range(3)
+COMPRESSIONS = {'none': NONE, 'zlib': ZLIB, 'zstd': ZSTD}
+
+
+def default_compression():
+    return 'zstd' if zstandard is not None else 'zlib'
+
+
+def _codec(compression):
+    if compression == NONE:
+        return bytes, bytes
+    if compression == ZLIB:
+        return (lambda data: zlib.compress(data, 1)), zlib.decompress
+    if compression == ZSTD:
+        if zstandard is None:
+            raise ValueError("This archive is zstd-compressed; install the zstandard package to read it")
+        return zstandard.ZstdCompressor(level=3).compress, zstandard.ZstdDecompressor().decompress
+    raise ValueError(f"Unknown archive compression {compression}")
+
+
+class ArchiveWriter:
+    def __init__(self, path, compression='zlib', block_size=BLOCK_SIZE):
+        if compression not in COMPRESSIONS:
+            raise ValueError(f"Unknown compression '{compression}'. Use one of: {', '.join(COMPRESSIONS)}.")
+        self.compress, _ = _codec(COMPRESSIONS[compression])
+        self.block_size = block_size
+        self.block = []
+        self.size = 0
+        self.count = 0
+        self.file = open(path, 'wb')
+        self.file.write(_HEADER.pack(MAGIC, VERSION, COMPRESSIONS[compression], 0))
+
+    def write(self, key, payload):
+        key = key.encode()
+        self.block.append(_RECORD.pack(len(key), len(payload)) + key + payload)
+        self.size += _RECORD.size + len(key) + len(payload)
+        self.count += 1
+        if self.size >= self.block_size:
+            self.flush()
+
+    def flush(self):
+        if not self.block:
+            return
+        raw = b''.join(self.block)
+        stored = self.compress(raw)
+        self.file.write(_BLOCK.pack(len(stored), len(raw), len(self.block), zlib.crc32(stored)))
+        self.file.write(stored)
+        self.block = []
+        self.size = 0
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_archive(path):
+    # Yields (key, payload) block by block
+    with open(path, 'rb') as file:
+        header = file.read(_HEADER.size)
+        if len(header) < _HEADER.size:
+            raise ValueError(f"{path} is not an address book archive")
+        magic, version, compression, _ = _HEADER.unpack(header)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a version {VERSION} address book archive")
+        _, decompress = _codec(compression)
+        number = 0
+        while True:
+            head = file.read(_BLOCK.size)
+            if not head:
+                return
+            number += 1
+            if len(head) < _BLOCK.size:
+                raise ValueError(f"{path}: block {number} is truncated")
+            stored_length, raw_length, count, checksum = _BLOCK.unpack(head)
+            stored = file.read(stored_length)
+            if len(stored) < stored_length or zlib.crc32(stored) != checksum:
+                raise ValueError(f"{path}: block {number} is damaged")
+            raw = decompress(stored)
+            if len(raw) != raw_length:
+                raise ValueError(f"{path}: block {number} is damaged")
+            offset = 0
+            for _ in range(count):
+                key_length, payload_length = _RECORD.unpack_from(raw, offset)
+                offset += _RECORD.size
+                key = raw[offset:offset + key_length].decode()
+                offset += key_length
+                yield key, raw[offset:offset + payload_length]
+                offset += payload_length
@@ -1,97 +1,525 @@
-from datetime import datetime, timedelta
-import pickle
+import time
+
+# When this module started importing, for --startup-profile
+IMPORT_STARTED = time.perf_counter()
+
+import argparse
+from array import array
+from bisect import bisect_left, insort
+import calendar
+from collections import Counter, defaultdict
+from datetime import date
+import heapq
+from itertools import chain, islice
+import math
+import os
+import re
+import sys
+import threading
+import unicodedata
+
+# columns (numpy), exchange and server are imported where they are first
+# used: together they are most of the import time, and a short session
+# often needs none of them
+from birthdays import BirthdayIndex, birthdays_per_week
+from commands import CommandRegistry, parse_options, write_result
+from history import ABSENT, History, absent
+from perf import PERF
+from query import scan_items, scan_mapping
+from storage import (
+    IndexedFile, JournaledFile, LazyMapping, ShardedMapping, StorageEngine, convert_legacy, decode_state, encode_state, legacy_state,
+    open_shards,
+)
+from validators import PHONE_DIGITS, format_phone, parse_birthday, parse_email, parse_phone, phone_prefix_ranges, validate_many
 
 class Field:
+    __slots__ = ('value',)
+
     def __init__(self, value):
         self.value = value
 
     def __str__(self):
         return str(self.value)
 
+    @classmethod
+    def restore(cls, value):
+        # Stored values were validated when they were entered
+        field = cls.__new__(cls)
+        field.value = value
+        return field
+
 class Name(Field):
-    pass
+    __slots__ = ()
 
 class Phone(Field):
+    # The value is the canonical text (see validators.format_phone), so
+    # "+38 (050) 123-45-67" and "0501234567" are the same phone
+    __slots__ = ()
+
     def __init__(self, value):
-        if not self.validate(value):
-            raise ValueError("Invalid phone number format")
-        super().__init__(value)
+        super().__init__(format_phone(parse_phone(value)))
 
     def validate(self, value):
-        return len(value) == 10 and value.isdigit()
+        try:
+            parse_phone(value)
+        except ValueError:
+            return False
+        return True
+
+    # Records keep phones packed as integers
+    def pack(self):
+        return parse_phone(self.value)
+
+    @classmethod
+    def unpack(cls, number):
+        return cls.restore(format_phone(number))
 
 class Email(Field):
+    __slots__ = ()
+
     def __init__(self, value):
-        if not self.validate(value):
-            raise ValueError("Invalid email format")
-        super().__init__(value)
+        super().__init__(parse_email(value))
 
     def validate(self, value):
-        # Implement email validation logic
-        return True  # Placeholder validation
+        try:
+            parse_email(value)
+        except ValueError:
+            return False
+        return True
 
 class Address(Field):
-    pass
+    __slots__ = ()
 
 class Birthday(Field):
+    # date holds the parsed value so nothing downstream re-parses the string
+    __slots__ = ('date',)
+
     def __init__(self, value=None):
-        if value and not self.validate(value):
-            raise ValueError("Invalid birthday format. Use DD.MM.YYYY")
+        self.date = parse_birthday(value) if value else None
         super().__init__(value)
 
     def validate(self, value):
-        # Add validation logic for DD.MM.YYYY format
-        pass
+        try:
+            parse_birthday(value)
+        except ValueError:
+            return False
+        return True
+
+    @classmethod
+    def restore(cls, value):
+        # Stored birthdays predate validation; keep unparseable ones as text
+        try:
+            return cls(value)
+        except ValueError:
+            birthday = cls()
+            birthday.value = value
+            return birthday
+
+CONTACT_FIELDS = ('name', 'phones', 'emails', 'addresses', 'birthday')
+FIELD_LABELS = {'name': 'Contact name', 'phones': 'phones', 'emails': 'emails', 'addresses': 'addresses', 'birthday': 'birthday'}
+
+def format_contact(state, fields=CONTACT_FIELDS):
+    # Renders a Record state, optionally projected onto some of CONTACT_FIELDS
+    name, phones, emails, addresses, birthday = state
+    values = {
+        'name': name,
+        'phones': '; '.join(phones),
+        'emails': '; '.join(emails),
+        'addresses': '; '.join(addresses),
+        'birthday': birthday or "Birthday not set.",
+    }
+    return ', '.join(f"{FIELD_LABELS[field]}: {values[field]}" for field in fields)
 
 class Record:
+    # Phones are stored as 10-digit integers in an array and emails/addresses
+    # as tuples (the empty tuple is shared), which keeps a contact to a few
+    # small objects instead of a list plus a Field object per value.
+    # str() is cached in _rendered until the next change.
+    __slots__ = ('name', '_phones', 'emails', 'addresses', 'birthday', 'book', '_rendered')
+
     def __init__(self, name):
         self.name = Name(name)
-        self.phones = []
-        self.emails = []
-        self.addresses = []
+        self._phones = array('q')
+        self.emails = ()
+        self.addresses = ()
         self.birthday = None
+        self.book = None
+        self._rendered = None
+
+    @property
+    def phones(self):
+        # A tuple: the numbers live in _phones, so changing a list returned
+        # here would silently do nothing
+        return tuple(Phone.unpack(number) for number in self._phones)
+
+    @phones.setter
+    def phones(self, phones):
+        # Like replace_phones, so the book's journal, indexes and history see it
+        numbers = array('q', (phone.pack() for phone in phones))
+        self._changing()
+        removed = self._phones
+        self._phones = numbers
+        self._changed(removed, numbers)
+
+    def _changing(self):
+        # Called before every change, so the book's history can keep the
+        # state the contact had
+        if self.book is not None:
+            self.book.record_changing(self)
+
+    def _changed(self, removed_phones=(), added_phones=()):
+        self._rendered = None
+        if self.book is not None:
+            self.book.record_changed(self, removed_phones, added_phones)
 
     def add_phone(self, phone):
-        self.phones.append(Phone(phone))
+        number = parse_phone(phone)
+        self._changing()
+        self._phones.append(number)
+        self._changed(added_phones=(number,))
 
     def add_email(self, email):
-        self.emails.append(Email(email))
+        email = Email(email)
+        self._changing()
+        self.emails += (email,)
+        self._changed()
 
     def add_address(self, address):
-        self.addresses.append(Address(address))
+        self._changing()
+        self.addresses += (Address(address),)
+        self._changed()
 
     def delete_phone(self, phone):
-        self.phones = [p for p in self.phones if p.value != phone]
+        number = parse_phone(phone)
+        self._changing()
+        removed = []
+        for i in reversed(range(len(self._phones))):
+            if self._phones[i] == number:
+                removed.append(self._phones.pop(i))
+        self._changed(removed_phones=removed)
 
     def delete_email(self, email):
-        self.emails = [e for e in self.emails if e.value != email]
+        self._changing()
+        self.emails = tuple(e for e in self.emails if e.value != email)
+        self._changed()
 
     def delete_address(self, address):
-        self.addresses = [a for a in self.addresses if a.value != address]
+        self._changing()
+        self.addresses = tuple(a for a in self.addresses if a.value != address)
+        self._changed()
 
     def edit_phone(self, old_phone, new_phone):
-        for i, phone in enumerate(self.phones):
-            if phone.value == old_phone:
-                self.phones[i] = Phone(new_phone)
+        old_number = parse_phone(old_phone)
+        for i, number in enumerate(self._phones):
+            if number == old_number:
+                new_number = parse_phone(new_phone)
+                self._changing()
+                self._phones[i] = new_number
+                self._changed((number,), (self._phones[i],))
                 break
 
+    def replace_phones(self, phone):
+        number = parse_phone(phone)
+        self._changing()
+        removed = self._phones
+        self._phones = array('q', [number])
+        self._changed(removed, self._phones)
+
     # Implement edit_email and edit_address methods similarly
 
     def add_birthday(self, birthday):
+        birthday = Birthday(birthday)
+        self._changing()
         self.birthday = birthday
+        self._changed()
 
     def show_birthday(self):
         return str(self.birthday) if self.birthday else "Birthday not set."
 
     def __str__(self):
-        phones_str = '; '.join(str(phone) for phone in self.phones)
-        emails_str = '; '.join(str(email) for email in self.emails)
-        addresses_str = '; '.join(str(address) for address in self.addresses)
-        return f"Contact name: {self.name}, phones: {phones_str}, emails: {emails_str}, addresses: {addresses_str}, birthday: {self.show_birthday()}"
+        if self._rendered is None:
+            self._rendered = format_contact(self.to_state())
+        return self._rendered
+
+    def to_state(self):
+        return (
+            self.name.value,
+            [format_phone(number) for number in self._phones],
+            [email.value for email in self.emails],
+            [address.value for address in self.addresses],
+            str(self.birthday) if self.birthday else None,
+        )
+
+    @classmethod
+    def from_state(cls, state):
+        # bot.py records only carry phones and a birthday
+        name, phones, *rest, birthday = state
+        emails, addresses = rest or ([], [])
+        record = cls(name)
+        record._phones = array('q', validate_many(parse_phone, phones))
+        record.emails = tuple(Email.restore(email) for email in emails)
+        record.addresses = tuple(Address(address) for address in addresses)
+        record.birthday = Birthday.restore(birthday) if birthday else None
+        return record
+
+    @classmethod
+    def from_input(cls, state):
+        # Like from_state, but validates emails and birthdays as user input
+        name, phones, emails, addresses, birthday = state
+        record = cls(name)
+        record._phones = array('q', validate_many(parse_phone, phones))
+        record.emails = tuple(Email.restore(email) for email in validate_many(parse_email, emails))
+        record.addresses = tuple(Address(address) for address in addresses)
+        record.birthday = Birthday(birthday) if birthday else None
+        return record
+
+class SortedBlocks:
+    # A sorted list kept as blocks of at most 2 * BLOCK_SIZE items, so
+    # inserting or removing one item only shifts a single short block.
+    BLOCK_SIZE = 512
+
+    def __init__(self, items=()):
+        items = sorted(items)
+        self.blocks = [items[i:i + self.BLOCK_SIZE] for i in range(0, len(items), self.BLOCK_SIZE)]
+        self.maxes = [block[-1] for block in self.blocks]
+
+    def add(self, item):
+        if not self.blocks:
+            self.blocks.append([item])
+            self.maxes.append(item)
+            return
+        i = min(bisect_left(self.maxes, item), len(self.blocks) - 1)
+        block = self.blocks[i]
+        insort(block, item)
+        self.maxes[i] = block[-1]
+        if len(block) > 2 * self.BLOCK_SIZE:
+            self.blocks[i:i + 1] = [block[:self.BLOCK_SIZE], block[self.BLOCK_SIZE:]]
+            self.maxes[i:i + 1] = [block[self.BLOCK_SIZE - 1], block[-1]]
+
+    def remove(self, item):
+        i = bisect_left(self.maxes, item)
+        block = self.blocks[i]
+        del block[bisect_left(block, item)]
+        if block:
+            self.maxes[i] = block[-1]
+        else:
+            del self.blocks[i]
+            del self.maxes[i]
+
+    def irange(self, low):
+        # Items >= low in ascending order
+        i = bisect_left(self.maxes, low)
+        if i < len(self.blocks):
+            yield from self.blocks[i][bisect_left(self.blocks[i], low):]
+            for block in self.blocks[i + 1:]:
+                yield from block
+
+class PhoneIndex:
+    # Reverse index from phone number to contact names. Numbers are packed
+    # 10-digit integers, so an exact lookup is one dict probe and a prefix is
+    # a contiguous range of numbers, scanned from sorted blocks that stay
+    # cheap to update one number at a time.
+    def __init__(self, entries=()):
+        self.owners = {}
+        for number, name in entries:
+            _add_owner(self.owners, number, name)
+        self.numbers = SortedBlocks(self.owners)
+
+    def add(self, number, name):
+        if _add_owner(self.owners, number, name):
+            self.numbers.add(number)
+
+    def remove(self, number, name):
+        if _remove_owner(self.owners, number, name):
+            self.numbers.remove(number)
+
+    def names(self, number):
+        return _owners(self.owners, number)
+
+    def find(self, phone):
+        return self.names(parse_phone(phone))
+
+    def find_prefix(self, prefix):
+        # A prefix of the numbers as displayed, so "+1555" finds +15551234567
+        for low, high in phone_prefix_ranges(prefix):
+            for number in self.numbers.irange(low):
+                if number >= high:
+                    break
+                for name in self.names(number):
+                    yield format_phone(number), name
+
+def _add_owner(owners, key, name):
+    # One owner is stored as a bare string, shared keys as a tuple. Returns
+    # True when the key is new.
+    current = owners.get(key)
+    if current is None:
+        owners[key] = name
+        return True
+    if isinstance(current, str):
+        current = (current,)
+    if name not in current:
+        owners[key] = current + (name,)
+    return False
+
+def _remove_owner(owners, key, name):
+    # Returns True when the key has no owners left
+    current = _owners(owners, key)
+    if name not in current:
+        return False
+    if len(current) > 1:
+        rest = tuple(owner for owner in current if owner != name)
+        owners[key] = rest[0] if len(rest) == 1 else rest
+        return False
+    del owners[key]
+    return True
+
+def _owners(owners, key):
+    current = owners.get(key, ())
+    return (current,) if isinstance(current, str) else current
+
+def normalize_name(name):
+    return unicodedata.normalize('NFKC', name).casefold()
+
+def trigrams(key):
+    padded = f"  {key} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def edit_distance(a, b, limit):
+    # Edit distance counting a swap of adjacent characters as one edit, or
+    # limit + 1 as soon as it must exceed limit
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    before, previous = None, list(range(len(b) + 1))
+    for i, char in enumerate(a, 1):
+        current = [i]
+        for j, other in enumerate(b, 1):
+            cost = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char != other))
+            if i > 1 and j > 1 and char == b[j - 2] and a[i - 2] == other:
+                cost = min(cost, before[j - 2] + 1)
+            current.append(cost)
+        if min(current) > limit:
+            return limit + 1
+        before, previous = previous, current
+    return previous[-1]
+
+class NameIndex:
+    # Contact names under their case-folded NFKC form. Prefix queries walk a
+    # sorted block list of keys; fuzzy queries count shared trigrams to pick
+    # a short list of candidates and only compute edit distances for those.
+    def __init__(self, names=()):
+        self.owners = {}
+        self.postings = defaultdict(set)
+        for name in names:
+            key = normalize_name(name)
+            if _add_owner(self.owners, key, name):
+                self._post(key)
+        self.keys = SortedBlocks(self.owners)
+
+    def _post(self, key):
+        for gram in trigrams(key):
+            self.postings[gram].add(key)
+
+    def add(self, name):
+        key = normalize_name(name)
+        if _add_owner(self.owners, key, name):
+            self.keys.add(key)
+            self._post(key)
+
+    def remove(self, name):
+        key = normalize_name(name)
+        if _remove_owner(self.owners, key, name):
+            self.keys.remove(key)
+            for gram in trigrams(key):
+                postings = self.postings[gram]
+                postings.discard(key)
+                if not postings:
+                    del self.postings[gram]
+
+    def prefix(self, query):
+        query = normalize_name(query)
+        for key in self.keys.irange(query):
+            if not key.startswith(query):
+                return
+            yield from _owners(self.owners, key)
+
+    def fuzzy(self, query, limit=10, max_distance=None):
+        # (distance, name) pairs for the closest names, best first
+        query = normalize_name(query)
+        if max_distance is None:
+            max_distance = max(1, min(3, len(query) // 3))
+        # Trigrams shared by a large part of the book (a common surname
+        # ending, say) add little to the ranking but dominate the counting,
+        # so they are skipped whenever a rarer one is available
+        postings = sorted((self.postings.get(gram, ()) for gram in trigrams(query)), key=len)
+        common = max(1000, len(self.owners) // 10)
+        counts = Counter()
+        for index, keys in enumerate(postings):
+            if index and len(keys) > common:
+                break
+            counts.update(keys)
+        matches = []
+        for key, shared in counts.most_common(max(50, limit * 10)):
+            distance = edit_distance(query, key, max_distance)
+            if distance <= max_distance:
+                matches.extend((distance, -shared, name) for name in _owners(self.owners, key))
+        return [(distance, name) for distance, _, name in heapq.nsmallest(limit, matches)]
+
+# Scan functions for AddressBook.scan; they run in worker processes, so they
+# live at module level and only see (name, state)
+
+def phone_entries(name, state):
+    for phone in state[1]:
+        yield parse_phone(phone), name
+
+def birthday_entries(name, state):
+    if state[-1]:
+        yield name, Birthday.restore(state[-1]).date
+
+CONTACT_FILTERS = ('name', 'phone', 'email', 'address', 'month', 'no-phone', 'no-birthday')
+
+def filter_contacts(name, state, kind, value):
+    _, phones, emails, addresses, birthday = state
+    if kind == 'name':
+        matched = value in normalize_name(name)
+    elif kind == 'phone':
+        matched = any(phone.startswith(value) for phone in phones)
+    elif kind == 'email':
+        matched = any(value in email.casefold() for email in emails)
+    elif kind == 'address':
+        matched = any(value in address.casefold() for address in addresses)
+    elif kind == 'month':
+        matched = birthday is not None and birthday[3:5] == value
+    elif kind == 'no-phone':
+        matched = not phones
+    else:
+        matched = birthday is None
+    if matched:
+        yield state
 
 class AddressBook:
+    # Above this many contacts `all` is formatted as it streams, not cached
+    LISTING_CACHE_LIMIT = 100_000
+
     def __init__(self):
-        self.data = {}
+        self.data = LazyMapping(self._decode, self._encode)
+        self.journal = None
+        self._phone_index = None
+        self._birthday_index = None
+        self._name_index = None
+        self._columns = None
+        self._listing = None
+        # The cache a full listing is filling while it streams, if any
+        self._filling = None
+        # A history.Tracked while undo is available, see PersonalAssistant
+        self.history = None
+
+    def _decode(self, payload):
+        record = Record.from_state(decode_state(payload))
+        record.book = self
+        return record
+
+    def _encode(self, record):
+        return encode_state(record.to_state())
 
     def find(self, name):
         if name in self.data:
@@ -100,166 +528,877 @@ class AddressBook:
     @classmethod
     def load_from_file(cls, filename):
         address_book = cls()
-        try:
-            with open(filename, 'rb') as file:
-                address_book.data = pickle.load(file)
-        except FileNotFoundError:
-            pass
+        journal = JournaledFile(filename)
+        store, legacy, entries = journal.load()
+        address_book.data.store = store
+        # Old pickle files are migrated to the indexed format on open
+        for name, value in legacy.items():
+            address_book._put(Record.from_state(legacy_state(value)))
+        for op, name, state in entries:
+            if op == 'put':
+                address_book._put(Record.from_state(state))
+            elif name in address_book.data:
+                del address_book.data[name]
+        journal.open(address_book.data.snapshot_items, rewrite=bool(legacy))
+        address_book.journal = journal
         return address_book
 
+    @classmethod
+    def load_shards(cls, filename, count, budget):
+        # Like load_from_file, for a book split by normalized name over
+        # `count` shard files (None: as many as it was split into), with at
+        # most `budget` bytes of them open at once
+        address_book = cls()
+        address_book.data = open_shards(
+            filename, count, budget, address_book._decode, address_book._encode, address_book._restore, normalize_name,
+        )
+        # The mapping routes journal writes to each key's shard itself
+        address_book.journal = address_book.data
+        return address_book
+
+    def _restore(self, state):
+        record = Record.from_state(state)
+        record.book = self
+        return record
+
+    def _put(self, record):
+        record.book = self
+        self.data[record.name.value] = record
+
     def save_to_file(self, filename):
-        with open(filename, 'wb') as file:
-            pickle.dump(self.data, file)
+        if isinstance(self.data, ShardedMapping):
+            if filename != self.data.filename:
+                raise ValueError("A sharded address book can only be saved in place")
+            self.data.save()
+            return
+        if self.journal is None or self.journal.filename != filename:
+            self.close()
+            # Only a journal that opened is kept, so a failure leaves none
+            journal = JournaledFile(filename)
+            journal.open(self.data.snapshot_items, rewrite=True)
+            self.journal = journal
+            self.data.rebase(IndexedFile(filename))
+        # Scans read the snapshot file directly, so follow compactions
+        self.journal.save(self.data.snapshot_items, self.data.rebase)
+
+    def close(self):
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
+    def record_changing(self, record):
+        if self.history is not None:
+            self.history.touch(record.name.value, record.to_state)
+
+    def record_changed(self, record, removed_phones=(), added_phones=()):
+        name = record.name.value
+        self.data.mark_dirty(name)
+        self._columns = None
+        self._filling = None
+        if self._listing is not None:
+            if name not in self._listing and len(self._listing) >= self.LISTING_CACHE_LIMIT:
+                self._listing = None
+            else:
+                self._listing[name] = str(record)
+        if self.journal is not None or self.history is not None:
+            # Both keep the encoded state, so encode it once
+            state = record.to_state()
+            payload = encode_state(state)
+            if self.journal is not None:
+                self.journal.put(name, state, payload)
+            if self.history is not None:
+                self.history.record(name, state, payload)
+        if self._phone_index is not None:
+            for number in removed_phones:
+                self._phone_index.remove(number, name)
+            for number in added_phones:
+                self._phone_index.add(number, name)
+        if self._birthday_index is not None:
+            self._birthday_index.update(name, record.birthday.date if record.birthday else None)
+
+    def states(self):
+        # (name, state) pairs for every contact without materializing Records
+        return self.data.scan(decode_state, Record.to_state)
+
+    def state(self, name):
+        return self.data.peek(name, decode_state, Record.to_state)
+
+    def rendered(self, offset=0, limit=None):
+        # The default listing, one line per contact in storage order, always
+        # streamed. A full listing of an in-memory book caches its lines as
+        # they go out; record_changed and delete then patch the cache line by
+        # line, so listing an unchanged book again formats nothing. Pages,
+        # sharded books and books over LISTING_CACHE_LIMIT are not cached.
+        stop = None if limit is None else offset + limit
+        if self._listing is not None:
+            return islice(self._listing.values(), offset, stop)
+        if offset or limit is not None or isinstance(self.data, ShardedMapping) or len(self.data) > self.LISTING_CACHE_LIMIT:
+            return (format_contact(state) for _, state in islice(self.states(), offset, stop))
+        return self._fill_listing()
+
+    def _fill_listing(self):
+        # Kept only if the listing ran to the end with no change meanwhile
+        listing = self._filling = {}
+        for name, state in self.states():
+            line = listing[name] = format_contact(state)
+            yield line
+        if self._filling is listing:
+            self._listing = listing
+            self._filling = None
+
+    def listing(self, sort=None, offset=0, limit=None):
+        # Contact states in storage order, by name or by birthday (calendar
+        # order, contacts without one last), paged with offset/limit. Storage
+        # and birthday order stream; name order sorts the names only, and
+        # just the top offset + limit of them when a limit is given.
+        if sort == 'name':
+            if limit is not None:
+                names = heapq.nsmallest(offset + limit, self.data)
+            else:
+                names = sorted(self.data)
+            states = (self.state(name) for name in names)
+        elif sort == 'birthday':
+            index = self.birthday_index
+            names = chain(
+                (name for bucket in index.buckets for name in sorted(bucket)),
+                (name for name in self.data if name not in index.slots),
+            )
+            states = (self.state(name) for name in names)
+        else:
+            states = (state for _, state in self.states())
+        return islice(states, offset, None if limit is None else offset + limit)
+
+    def scan(self, function, *args):
+        # Results of function(name, state, *args) over every contact, spread
+        # over worker processes for large books
+        return scan_mapping(self.data, Record.to_state, function, args)
+
+    @property
+    def phone_index(self):
+        # Built on first use, then kept current by record_changed
+        if self._phone_index is None:
+            self._phone_index = PhoneIndex(self.scan(phone_entries))
+        return self._phone_index
+
+    @property
+    def birthday_index(self):
+        if self._birthday_index is None:
+            self._birthday_index = BirthdayIndex(self.scan(birthday_entries))
+        return self._birthday_index
+
+    @property
+    def columns(self):
+        # Rebuilt on the first report after any change
+        from columns import NUMPY_MISSING, ContactColumns, column_rows, np
+
+        if np is None:
+            raise ValueError(NUMPY_MISSING)
+        if self._columns is None:
+            self._columns = ContactColumns(self.scan(column_rows))
+        return self._columns
+
+    @property
+    def name_index(self):
+        if self._name_index is None:
+            self._name_index = NameIndex(self.data)
+        return self._name_index
+
+    def search(self, query, limit=10):
+        # Names starting with query first, then the closest fuzzy matches
+        index = self.name_index
+        results = list(islice(index.prefix(query), limit))
+        if len(results) == limit:
+            return results
+        seen = set(results)
+        for _, name in index.fuzzy(query, limit):
+            if len(results) >= limit:
+                break
+            if name not in seen:
+                results.append(name)
+                seen.add(name)
+        return results
 
     def add_record(self, record):
         if record.name.value not in self.data:
+            if self.history is not None:
+                self.history.touch(record.name.value, absent)
             self.data[record.name.value] = record
+            record.book = self
+            self.record_changed(record, added_phones=record._phones)
+            if self._name_index is not None:
+                self._name_index.add(record.name.value)
             return "Contact added."
         else:
             return f"Contact '{record.name.value}' already exists."
 
-    # Implement other methods like delete, find, get_birthdays_per_week, etc.
+    def delete(self, name):
+        record = self.data.pop(name, None)
+        if record is not None:
+            if self.history is not None:
+                self.history.touch(name, record.to_state)
+                self.history.record(name, ABSENT)
+            record.book = None
+            self._columns = None
+            self._filling = None
+            if self._listing is not None:
+                del self._listing[name]
+            if self._phone_index is not None:
+                for number in record._phones:
+                    self._phone_index.remove(number, name)
+            if self._birthday_index is not None:
+                self._birthday_index.update(name, None)
+            if self._name_index is not None:
+                self._name_index.remove(name)
+            if self.journal is not None:
+                self.journal.delete(name)
+
+    def get_birthdays_per_week(self, today=None):
+        return birthdays_per_week(self.birthday_index, today or date.today())
 
 class Note:
-    def __init__(self, content, tags):
+    __slots__ = ('id', 'content', 'tags', 'manager')
+
+    def __init__(self, content, tags, id=None):
+        self.id = id
         self.content = content
-        self.tags = tags
+        # Tags repeat across many notes, so share one string object per tag
+        self.tags = [sys.intern(tag) for tag in tags]
+        self.manager = None
 
     def edit_content(self, new_content):
+        old_content = self.content
         self.content = new_content
+        if self.manager is not None:
+            self.manager.content_changed(self, old_content)
 
     def add_tag(self, tag):
+        tag = sys.intern(tag)
         self.tags.append(tag)
+        if self.manager is not None:
+            self.manager.tag_added(self, tag)
+
+    def to_state(self):
+        return (self.id, self.content, list(self.tags))
+
+    @classmethod
+    def from_state(cls, state):
+        note_id, content, tags = state
+        return cls(content, tags, note_id)
+
+TOKEN_PATTERN = re.compile(r'\w+')
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(text.lower())
+
+def match_note(note_id, state, pattern):
+    # Scan function for NotesManager.scan
+    if re.search(pattern, state[1]):
+        yield note_id
 
 class NotesManager:
+    # Notes are kept in a dict keyed by a stable, increasing id, so a single
+    # note is found or deleted in O(1). tag_index maps a tag to the ids
+    # carrying it (a dict used as an insertion-ordered set) and postings maps
+    # a content token to {id: term frequency}, so tag lookups cost O(matches)
+    # and keyword search only touches the notes containing a query term.
+    BM25_K1 = 1.2
+    BM25_B = 0.75
+
+    # Snapshot key holding next_id, so ids of deleted notes are never reused
+    NEXT_ID_KEY = 'next_id'
+
     def __init__(self):
-        self.notes = []
+        self.notes = {}
+        self.next_id = 1
+        self.tag_index = defaultdict(dict)
+        self.postings = defaultdict(dict)
+        self.lengths = {}
+        self.total_length = 0
+        self.journal = None
+        # Like AddressBook.history; notes report their change after the
+        # fact, with what the old state is rebuilt from
+        self.history = None
+
+    @classmethod
+    def load_from_file(cls, filename):
+        # Unlike contacts, notes are decoded eagerly: the tag and content
+        # indexes need every note. The segment itself is only opened when a
+        # notes command first runs.
+        manager = cls()
+        journal = JournaledFile(filename)
+        store, _, entries = journal.load()
+        for key, payload in store.items():
+            if key == cls.NEXT_ID_KEY:
+                manager.next_id = max(manager.next_id, decode_state(payload))
+            else:
+                manager.add_note(Note.from_state(decode_state(payload)))
+        for op, key, state in entries:
+            note_id = int(key)
+            manager.next_id = max(manager.next_id, note_id + 1)
+            if note_id in manager.notes:
+                manager._remove(note_id)
+            if op == 'put':
+                manager.add_note(Note.from_state(state))
+        journal.open(manager.snapshot_items)
+        manager.journal = journal
+        return manager
+
+    def snapshot_items(self):
+        # Like LazyMapping.snapshot_items: capture the notes now, encode them
+        # on the writer thread
+        notes = list(self.notes.items())
+        next_id = self.next_id
+
+        def items():
+            for note_id, note in notes:
+                yield str(note_id), encode_state(note.to_state())
+            yield self.NEXT_ID_KEY, encode_state(next_id)
+
+        return items()
+
+    def save_to_file(self, filename):
+        if self.journal is None or self.journal.filename != filename:
+            self.close()
+            journal = JournaledFile(filename)
+            journal.open(self.snapshot_items, rewrite=True)
+            self.journal = journal
+        self.journal.save(self.snapshot_items)
+
+    def close(self):
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
+    def scan(self, function, *args):
+        # Like AddressBook.scan, over (id, state) pairs
+        states = ((note_id, note.to_state()) for note_id, note in self.notes.items())
+        return scan_items(states, len(self.notes), function, args)
+
+    def note_changed(self, note):
+        if self.journal is not None or self.history is not None:
+            state = note.to_state()
+            payload = encode_state(state)
+            if self.journal is not None:
+                self.journal.put(str(note.id), state, payload)
+            if self.history is not None:
+                self.history.record(note.id, state, payload)
 
     def add_note(self, note):
-        self.notes.append(note)
+        if note.id is None:
+            note.id = self.next_id
+        self.next_id = max(self.next_id, note.id + 1)
+        if self.history is not None:
+            self.history.touch(note.id, absent)
+        note.manager = self
+        self.notes[note.id] = note
+        for tag in note.tags:
+            self.tag_index[tag][note.id] = None
+        self._index_content(note.id, note.content)
+        self.note_changed(note)
+        return note.id
+
+    def find(self, note_id):
+        return self.notes.get(note_id)
+
+    def _index_content(self, note_id, content):
+        tokens = tokenize(content)
+        for token, count in Counter(tokens).items():
+            self.postings[token][note_id] = count
+        self.lengths[note_id] = len(tokens)
+        self.total_length += len(tokens)
+
+    def _unindex_content(self, note_id, content):
+        for token in set(tokenize(content)):
+            postings = self.postings[token]
+            postings.pop(note_id, None)
+            if not postings:
+                del self.postings[token]
+        self.total_length -= self.lengths.pop(note_id, 0)
+
+    def content_changed(self, note, old_content):
+        if self.history is not None:
+            self.history.touch(note.id, lambda: (note.id, old_content, list(note.tags)))
+        self._unindex_content(note.id, old_content)
+        self._index_content(note.id, note.content)
+        self.note_changed(note)
+
+    def tag_added(self, note, tag):
+        if self.history is not None:
+            self.history.touch(note.id, lambda: (note.id, note.content, note.tags[:-1]))
+        self.tag_index[tag][note.id] = None
+        self.note_changed(note)
+
+    def _remove(self, note_id):
+        note = self.notes.pop(note_id)
+        if self.history is not None:
+            self.history.touch(note_id, note.to_state)
+            self.history.record(note_id, ABSENT)
+        for tag in note.tags:
+            ids = self.tag_index.get(tag)
+            if ids is not None:
+                ids.pop(note_id, None)
+                if not ids:
+                    del self.tag_index[tag]
+        self._unindex_content(note_id, note.content)
+        note.manager = None
+        if self.journal is not None:
+            self.journal.delete(str(note_id))
+        return note
+
+    def delete_note(self, note_id):
+        if note_id in self.notes:
+            return self._remove(note_id)
 
     def delete_notes_by_tag(self, tag):
-        self.notes = [note for note in self.notes if tag not in note.tags]
+        ids = list(self.tag_index.get(tag, ()))
+        for note_id in ids:
+            self._remove(note_id)
+        return len(ids)
 
     def search_notes_by_tag(self, tag):
-        return [note for note in self.notes if tag in note.tags]
+        return [self.notes[note_id] for note_id in self.tag_index.get(tag, ())]
 
-    # Implement other note management methods
+    def search_notes_by_tags(self, tags, match_all=True):
+        postings = [self.tag_index.get(tag, {}) for tag in tags]
+        if not match_all:
+            ids = dict.fromkeys(note_id for ids in postings for note_id in ids)
+        else:
+            postings.sort(key=len)
+            smallest, rest = postings[0], postings[1:]
+            ids = [note_id for note_id in smallest if all(note_id in other for other in rest)]
+        return [self.notes[note_id] for note_id in ids]
+
+    def search_notes(self, query, limit=10):
+        # Okapi BM25 over the content postings
+        count = len(self.lengths)
+        if not count:
+            return []
+        average_length = self.total_length / count or 1
+        scores = defaultdict(float)
+        for token in set(tokenize(query)):
+            postings = self.postings.get(token)
+            if not postings:
+                continue
+            idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for note_id, frequency in postings.items():
+                norm = self.BM25_K1 * (1 - self.BM25_B + self.BM25_B * self.lengths[note_id] / average_length)
+                scores[note_id] += idf * frequency * (self.BM25_K1 + 1) / (frequency + norm)
+        best = heapq.nlargest(limit, scores.items(), key=lambda item: item[1])
+        return [(self.notes[note_id], score) for note_id, score in best]
+
+COMMANDS = CommandRegistry()
 
 class PersonalAssistant:
-    def __init__(self):
-        self.address_book = AddressBook()
-        self.notes_manager = NotesManager()
-
-    # def input_error(func):
-    #     def inner(*args, **kwargs):
-    #         try:
-    #             return func(*args, **kwargs)
-    #         except ValueError:
-    #             return "Give me name and phone please."
-    #         except KeyError as e:
-    #             return f"Error: Key '{e.args[0]}' does not exist."
-    #         except IndexError:
-    #             return "Error: Insufficient arguments."
-
-    #     return inner
-
+    CONTACTS = 'contacts'
+    NOTES = 'notes'
+
+    def __init__(self, storage=None):
+        self.storage = storage
+        # With storage the contacts are opened by load() or
+        # load_in_background(); without, the book starts empty in memory
+        self._address_book = AddressBook() if storage is None else None
+        self._notes_manager = None
+        # Set while load_in_background() runs, with the error it raised
+        self._loading = None
+        self._load_error = None
+        self.start_history()
+
+    @property
+    def address_book(self):
+        if self._loading is not None:
+            self._wait_loaded()
+        return self._address_book
+
+    @address_book.setter
+    def address_book(self, address_book):
+        self._wait_loaded()
+        self._address_book = address_book
+        address_book.history = self.history.part(self.CONTACTS)
+
+    def load_in_background(self, done=None):
+        # Opens the contacts on a thread, so the prompt can be shown at once;
+        # the first command that uses them waits for the thread. done(seconds)
+        # is called on the thread when the contacts are open.
+        self._wait_loaded()
+        self._loading = threading.Event()
+        threading.Thread(target=self._load_contacts, args=(done,), name="load", daemon=True).start()
+
+    def _load_contacts(self, done):
+        started = time.perf_counter()
+        try:
+            address_book = self._open_contacts()
+            address_book.history = self.history.part(self.CONTACTS)
+            self._address_book = address_book
+        except BaseException as error:
+            self._load_error = error
+        finally:
+            self._loading.set()
+        if done is not None and self._load_error is None:
+            done(time.perf_counter() - started)
+
+    def _wait_loaded(self):
+        loading = self._loading
+        if loading is None:
+            return
+        loading.wait()
+        # Like a failed load at startup, this ends the session rather than
+        # being reported as one command's error
+        if self._load_error is not None:
+            raise RuntimeError(f"Could not open the contacts: {self._load_error}") from self._load_error
+        self._loading = None
+
+    def _open_contacts(self):
+        path = self.storage.path(self.CONTACTS)
+        if self.storage.is_sharded(self.CONTACTS):
+            return AddressBook.load_shards(path, self.storage.shards or None, self.storage.shard_budget)
+        return AddressBook.load_from_file(path)
+
+    # Each kind of data is its own storage segment: contacts are opened at
+    # startup, notes only when a notes command first needs them, and saving
+    # one never rewrites the other.
+    @property
+    def notes_manager(self):
+        if self._notes_manager is None:
+            if self.storage is None:
+                self._notes_manager = NotesManager()
+            else:
+                self._notes_manager = NotesManager.load_from_file(self.storage.path(self.NOTES))
+            self._notes_manager.history = self.history.part(self.NOTES)
+        return self._notes_manager
+
+    @notes_manager.setter
+    def notes_manager(self, notes_manager):
+        self._notes_manager = notes_manager
+        notes_manager.history = self.history.part(self.NOTES)
+
+    def start_history(self):
+        # Undo, redo and snapshots cover the changes since the data was loaded
+        self.history = History((self.CONTACTS, self.NOTES), encode_state, decode_state)
+        if self._address_book is not None:
+            self._address_book.history = self.history.part(self.CONTACTS)
+        if self._notes_manager is not None:
+            self._notes_manager.history = self.history.part(self.NOTES)
+
+    def load(self):
+        self.close()
+        self._address_book = self._open_contacts()
+        self._notes_manager = None
+        self.start_history()
+
+    def save(self):
+        self.address_book.save_to_file(self.storage.path(self.CONTACTS))
+        if self._notes_manager is not None:
+            self._notes_manager.save_to_file(self.storage.path(self.NOTES))
+
+    def close(self):
+        self._wait_loaded()
+        if self._address_book is not None:
+            self._address_book.close()
+        if self._notes_manager is not None:
+            self._notes_manager.close()
+
+    #GENERAL
+
+    @COMMANDS.command("hello", help="Greet the assistant")
+    def hello(self):
+        return "How can I help you?"
 
+    @COMMANDS.command("help", help="List available commands")
+    def show_help(self):
+        return COMMANDS.help()
 
+    @COMMANDS.command("save", help="Save contacts and notes")
+    def save_command(self):
+        try:
+            self.save()
+        except OSError as e:
+            return f"Save failed: {e}"
+        return "Address book and notes saved."
+
+    @COMMANDS.command("load", help="Reload contacts and notes from disk", writes=True)
+    def load_command(self):
+        self.load()
+        return "Address book and notes loaded."
+
+    @COMMANDS.command("exit", "close", help="Save everything and quit")
+    def exit_command(self):
+        # A failed save is reported and the session stays open. close()
+        # syncs every journal again, so an error left by an earlier
+        # background write only counts if that fails too.
+        try:
+            self.save()
+        except OSError:
+            pass
+        try:
+            self.close()
+        except OSError as e:
+            return f"Save failed: {e}"
+        return "Good bye!"
 
-    # Implement contact management methods (add_contact, delete_contact, search_contact, etc.)
+    #HISTORY
 
-    # Implement note management methods (add_note, delete_note, search_note, etc.)
+    def _apply(self, changes):
+        # Puts contacts and notes into the given states through the usual
+        # add/delete paths, so indexes and the journal follow
+        self.history.paused = True
+        try:
+            for part, key, state in changes:
+                if part == self.CONTACTS:
+                    self.address_book.delete(key)
+                    if state is not ABSENT:
+                        self.address_book.add_record(Record.from_state(state))
+                else:
+                    self.notes_manager.delete_note(key)
+                    if state is not ABSENT:
+                        self.notes_manager.add_note(Note.from_state(state))
+        finally:
+            self.history.paused = False
+
+    @COMMANDS.command("undo", help="Undo the last change to contacts or notes", writes=True)
+    def undo(self):
+        changes = self.history.undo()
+        if changes is None:
+            return "Nothing to undo."
+        self._apply(changes)
+        return f"Undone, {len(changes)} contacts or notes changed back."
+
+    @COMMANDS.command("redo", help="Redo the last undone change", writes=True)
+    def redo(self):
+        changes = self.history.redo()
+        if changes is None:
+            return "Nothing to redo."
+        self._apply(changes)
+        return f"Redone, {len(changes)} contacts or notes changed again."
+
+    @COMMANDS.command("snapshot", args="label", help="Remember the current contacts and notes under a label", writes=True)
+    def snapshot(self, label):
+        self.history.snapshot(label)
+        return f"Snapshot '{label}' taken."
+
+    @COMMANDS.command("restore", args="label", help="Return contacts and notes to a snapshot; undo reverts it", writes=True)
+    def restore(self, label):
+        if label not in self.history.labels:
+            labels = ', '.join(self.history.labels) or "none taken"
+            return f"No snapshot '{label}'. Snapshots: {labels}."
+        changes = self.history.restore(label)
+        self._apply(changes)
+        return f"Restored snapshot '{label}', {len(changes)} contacts or notes changed."
 
     #CONTACTS
 
     def display_contacts_with_upcoming_birthdays(self, days):
-        today = datetime.now()
         upcoming_birthdays = []
-        for record in self.address_book.data.values():
-            if record.birthday:
-                birth_date = datetime.strptime(record.birthday.value, '%d.%m.%Y')
-                if birth_date.month == today.month and birth_date.day - today.day <= days:
-                    upcoming_birthdays.append(str(record))
-        return
-    
-    # @input_error
-    def add_contact(self, args, address_book):
-        if len(args) == 2:
-            name, phone = args
-            # address_book[name] = phone
-            record = Record(name)  # Create a Record instance with the provided name
-            record.add_phone(phone)  # Add the phone number to the Record
-            address_book.add_record(record)  # Add the Record to the AddressBook
-            return "Contact added."
+        for day, name in self.address_book.birthday_index.upcoming(date.today(), days):
+            upcoming_birthdays.append(f"{day.strftime('%d.%m')}: {self.address_book.find(name)}")
+        return upcoming_birthdays
+
+    @COMMANDS.command("add", args="name phone", help="Add a contact with a phone number", writes=True)
+    def add_contact(self, name, phone):
+        record = Record(name)  # Create a Record instance with the provided name
+        record.add_phone(phone)  # Add the phone number to the Record
+        return self.address_book.add_record(record)  # Add the Record to the AddressBook
+
+    @COMMANDS.command("change", args="name phone", help="Replace a contact's phone numbers", writes=True)
+    def change_contact(self, name, phone):
+        record = self.address_book.find(name)
+        if record:
+            record.replace_phones(phone)  # Update the phone number for the found record
+            return f"Phone number updated for {name}."
         else:
-            return "Invalid command format for adding a contact."
-
-    # @input_error
-    def change_contact(self, args, address_book):
-        if len(args) == 2:
-            name, phone = args
-            record = address_book.find(name)
-            if record:
-                record.phones = [Phone(phone)]  # Update the phone number for the found record
-                return f"Phone number updated for {name}."
-            else:
-                return f"{name} does not exist in contacts."
+            return f"{name} does not exist in contacts."
+
+    @COMMANDS.command("delete", args="name", help="Delete a contact", writes=True)
+    def delete_contact(self, name):
+        if self.address_book.find(name):
+            self.address_book.delete(name)
+            return f"Contact {name} deleted."
         else:
-            return "Invalid command format for changing a contact's phone number."
-
-    # @input_error
-    def get_phone(self, args, address_book):
-        if len(args) == 1:
-            name = args[0]
-            record = address_book.find(name)
-            if record:
-                return f"Phone number for {name}: {record.phones}"
-            else:
-                return f"{name} does not exist in contacts."
+            return f"{name} does not exist in contacts."
+
+    @COMMANDS.command("find-by-phone", args="phone [limit:int]", help="Find contacts by phone number or prefix")
+    def find_by_phone(self, phone, limit=20):
+        # Fewer than 10 bare digits, or '+' and at most 10 (no international
+        # number is that short), is a prefix; anything else one number
+        if phone[:1] == '+':
+            prefix = phone[1:].isdigit() and len(phone) <= PHONE_DIGITS + 1
         else:
-            return "Invalid command format for retrieving a phone number."
-
-    # @input_error
-    def display_all(self, address_book):
-        if address_book:
-            result = "All contacts:\n"
-            for record in address_book.data.values():
-                result += f"{str(record)}\n"
-            return result
+            prefix = phone.isdigit() and len(phone) < PHONE_DIGITS
+        if not prefix:
+            names = self.address_book.phone_index.find(phone)
+            if names:
+                return f"Contacts with phone {phone}: {', '.join(names)}"
+            return f"No contacts with phone {phone}."
+        matches = list(islice(self.address_book.phone_index.find_prefix(phone), limit))
+        if matches:
+            return f"Contacts with phones starting with {phone}:\n" + "\n".join(f"{number}: {name}" for number, name in matches)
+        return f"No contacts with phones starting with {phone}."
+
+    @COMMANDS.command("search", args="query [limit:int]", help="Find contacts by name prefix or approximate spelling")
+    def search_contacts(self, query, limit=10):
+        names = self.address_book.search(query, limit)
+        if names:
+            return f"Contacts matching '{query}':\n" + "\n".join(names)
+        return f"No contacts matching '{query}'."
+
+    @COMMANDS.command("phone", args="name", help="Show a contact's phone numbers")
+    def get_phone(self, name):
+        record = self.address_book.find(name)
+        if record:
+            return f"Phone number for {name}: {'; '.join(str(phone) for phone in record.phones)}"
+        else:
+            return f"{name} does not exist in contacts."
+
+    @COMMANDS.command("all", args="[*options]", help="Show contacts; options: --limit N --offset N --sort name|birthday --fields name,phones,...")
+    def display_all(self, options=''):
+        options = parse_options(options.split(), ('limit', 'offset', 'sort', 'fields'))
+        limit = int(options['limit']) if 'limit' in options else None
+        offset = int(options.get('offset', 0))
+        sort = options.get('sort')
+        fields = tuple(options['fields'].split(',')) if 'fields' in options else CONTACT_FIELDS
+        if sort not in (None, 'name', 'birthday'):
+            raise ValueError("Sort by 'name' or 'birthday'")
+        if not set(fields) <= set(CONTACT_FIELDS):
+            raise ValueError(f"Fields must be among: {','.join(CONTACT_FIELDS)}")
+        if self.address_book.data:
+            if sort is None and fields == CONTACT_FIELDS:
+                return chain(["All contacts:"], self.address_book.rendered(offset, limit))
+            return self._render_contacts(self.address_book.listing(sort, offset, limit), fields)
         else:
             return "No contacts available."
 
-    # @input_error
-    def add_birthday(self, args, address_book):
-        if len(args) == 2:
-            name, birthday = args
-            print(name)
-            print(birthday)
-            record = self.address_book.find(name)
-            if record:
-                record.add_birthday(birthday)
-                return f"Birthday added for {name}."
-            else:
-                return f"{name} does not exist in the address book."
-        else:
-            return "Invalid command format for adding a birthday."
-
-    # @input_error
-    def show_birthday(self, args, address_book):
-        if len(args) == 1:
-            name = args[0]
-            record = address_book.find(name)
-            if record:
-                return f"Birthday for {name}: {record.show_birthday()}"
-            else:
-                return f"{name} does not exist in the address book."
+    @COMMANDS.command("filter", args="kind [value]", help=f"Show contacts matching a filter: {', '.join(CONTACT_FILTERS)}")
+    def filter_contacts(self, kind, value=''):
+        if kind not in CONTACT_FILTERS:
+            raise ValueError(f"Filter by one of: {', '.join(CONTACT_FILTERS)}")
+        if not value and kind not in ('no-phone', 'no-birthday'):
+            raise ValueError(f"Usage: filter {kind} value")
+        if kind == 'name':
+            value = normalize_name(value)
+        elif kind in ('email', 'address'):
+            value = value.casefold()
+        elif kind == 'phone' and not value.removeprefix('+').isdigit():
+            raise ValueError("Invalid phone number format")
+        elif kind == 'month':
+            if not value.isdigit() or not 1 <= int(value) <= 12:
+                raise ValueError("Month must be a number from 1 to 12")
+            value = f"{int(value):02d}"
+        return self._render_contacts(self.address_book.scan(filter_contacts, kind, value), CONTACT_FIELDS, "Matching contacts:")
+
+    @COMMANDS.command("stats", args="[kind]", help="Summarize the address book, or 'stats perf' for command timings")
+    def show_stats(self, kind='contacts'):
+        if kind == 'perf':
+            return PERF.report()
+        if kind != 'contacts':
+            raise ValueError("Use: stats [contacts|perf]")
+        summary = self.address_book.columns.summary()
+        return "\n".join(f"{label}: {value}" for label, value in summary)
+
+    @COMMANDS.command("perf", args="action [value:int]", help="Instrumentation: on, off, reset, slow <ms>, profile <n>, memory <n>")
+    def perf_command(self, action, value=None):
+        if action == 'on':
+            PERF.enable(COMMANDS)
+            return "Instrumentation on."
+        if action == 'off':
+            PERF.disable()
+            return "Instrumentation off."
+        if action == 'reset':
+            PERF.reset()
+            return "Instrumentation counters reset."
+        if value is None or value <= 0 or action not in ('slow', 'profile', 'memory'):
+            raise ValueError("Use: perf on|off|reset, perf slow <ms>, perf profile <n>, perf memory <n>")
+        if action == 'slow':
+            PERF.slow_threshold = value / 1e3
+            return f"Commands taking {value} ms or more are logged."
+        # Captures need the dispatch wrapper to count commands
+        PERF.enable(COMMANDS)
+        PERF.start_capture(action, value)
+        return f"Capturing a {action} of the next {value} commands; see stats perf."
+
+    @COMMANDS.command("report", args="kind [digits:int]", help="Contact reports: months, prefixes [digits], no-phone")
+    def show_report(self, kind, digits=3):
+        columns = self.address_book.columns
+        if kind == 'months':
+            counts = columns.birthdays_per_month()
+            return "Birthdays per month:\n" + "\n".join(
+                f"{calendar.month_name[month]}: {count}" for month, count in enumerate(counts, 1)
+            )
+        if kind == 'prefixes':
+            if not 1 <= digits <= 10:
+                raise ValueError("Prefix length must be from 1 to 10 digits")
+            return f"Most common {digits}-digit phone prefixes:\n" + "\n".join(
+                f"{prefix}: {count}" for prefix, count in columns.phone_prefixes(digits)
+            )
+        if kind == 'no-phone':
+            names = columns.without_phone()
+            return f"Contacts without a phone: {len(names)}" + "".join(f"\n{name}" for name in names)
+        raise ValueError("Report one of: months, prefixes, no-phone")
+
+    def _render_contacts(self, states, fields, header="All contacts:"):
+        # A generator, so the listing is written out line by line
+        yield header
+        for state in states:
+            yield format_contact(state, fields)
+
+    @COMMANDS.command("import", args="format path [workers:int]", help="Import contacts from a csv, vcard or binary file; bad rows go to <path>.rejects.csv", writes=True)
+    def import_contacts(self, file_format, path, workers=0):
+        from exchange import READERS, RejectWriter, validated_batches
+
+        if file_format not in READERS:
+            return f"Unknown format '{file_format}'. Use one of: {', '.join(READERS)}."
+        rejects = RejectWriter(path + '.rejects.csv')
+        imported = 0
+        try:
+            # Records are built (and so validated) in batches, optionally in a process pool
+            for records, rejected in validated_batches(READERS[file_format](path), Record.from_input, workers):
+                for line, state, error in rejected:
+                    rejects.write(line, state, error)
+                for line, record in records:
+                    if record.name.value in self.address_book.data:
+                        rejects.write(line, record.to_state(), "Contact already exists")
+                    else:
+                        self.address_book.add_record(record)
+                        imported += 1
+        finally:
+            rejects.close()
+        result = f"Imported {imported} contacts from {path}."
+        if rejects.count:
+            result += f" {rejects.count} rejected, see {rejects.path}."
+        return result
+
+    @COMMANDS.command("export", args="format path", help="Export all contacts to a csv, vcard or binary file")
+    def export_contacts(self, file_format, path):
+        from exchange import WRITERS
+
+        if file_format not in WRITERS:
+            return f"Unknown format '{file_format}'. Use one of: {', '.join(WRITERS)}."
+        count = WRITERS[file_format](path, (state for _, state in self.address_book.states()))
+        return f"Exported {count} contacts to {path}."
+
+    @COMMANDS.command("add-birthday", args="name birthday", help="Set a contact's birthday (DD.MM.YYYY)", writes=True)
+    def add_birthday(self, name, birthday):
+        record = self.address_book.find(name)
+        if record:
+            record.add_birthday(birthday)
+            return f"Birthday added for {name}."
         else:
-            return "Invalid command format for displaying a birthday."
+            return f"{name} does not exist in the address book."
 
-    # @input_error
-    def birthdays(self, address_book):
-        upcoming_birthdays = address_book.get_birthdays_per_week()
+    @COMMANDS.command("show-birthday", args="name", help="Show a contact's birthday")
+    def show_birthday(self, name):
+        record = self.address_book.find(name)
+        if record:
+            return f"Birthday for {name}: {record.show_birthday()}"
+        else:
+            return f"{name} does not exist in the address book."
+
+    @COMMANDS.command("birthdays", args="[days:int]", help="Show birthdays this week, or in the next N days")
+    def birthdays(self, days=None):
+        if days is not None:
+            upcoming_birthdays = self.display_contacts_with_upcoming_birthdays(days)
+            if upcoming_birthdays:
+                return f"Birthdays in the next {days} days:\n" + "\n".join(upcoming_birthdays)
+            return f"No birthdays in the next {days} days."
+        upcoming_birthdays = self.address_book.get_birthdays_per_week()
         if upcoming_birthdays:
             return "Upcoming birthdays:\n" + "\n".join(upcoming_birthdays)
         else:
@@ -267,76 +1406,227 @@ class PersonalAssistant:
 
     #NOTES
 
+    @COMMANDS.command("add-note", args="*content tags", help="Add a note with comma-separated tags", writes=True)
     def add_note(self, content, tags):
-        note = Note(content, tags)
-        self.notes_manager.add_note(note)
-        return "Note added successfully."
+        note = Note(content, tags.split(','))
+        note_id = self.notes_manager.add_note(note)
+        return f"Note {note_id} added successfully."
+
+    @COMMANDS.command("delete-note", args="id:int", help="Delete a note by id", writes=True)
+    def delete_note(self, note_id):
+        if self.notes_manager.delete_note(note_id):
+            return f"Note {note_id} deleted."
+        else:
+            return f"Note {note_id} does not exist."
+
+    @COMMANDS.command("edit-note", args="id:int *content", help="Replace a note's content", writes=True)
+    def edit_note(self, note_id, content):
+        note = self.notes_manager.find(note_id)
+        if note:
+            note.edit_content(content)
+            return f"Note {note_id} updated."
+        else:
+            return f"Note {note_id} does not exist."
 
+    @COMMANDS.command("delete-notes-by-tag", args="tag", help="Delete every note with a tag", writes=True)
     def delete_notes_by_tag(self, tag):
         self.notes_manager.delete_notes_by_tag(tag)
         return f"Notes with tag '{tag}' deleted."
 
+    @COMMANDS.command("search-notes-by-tag", args="tag", help="List notes with a tag")
     def search_notes_by_tag(self, tag):
         matching_notes = self.notes_manager.search_notes_by_tag(tag)
         if matching_notes:
             result = f"Matching notes for tag '{tag}':\n"
             for note in matching_notes:
-                result += f"Content: {note.content}, Tags: {note.tags}\n"
+                result += f"ID: {note.id}, Content: {note.content}, Tags: {note.tags}\n"
             return result
         else:
             return f"No notes found for tag '{tag}'."
 
+    @COMMANDS.command("search-notes-by-tags", args="tags [mode]", help="List notes with all (and) or any (or) of comma-separated tags")
+    def search_notes_by_tags(self, tags, mode="and"):
+        if mode not in ("and", "or"):
+            return "Invalid command format for searching notes by tags."
+        tags = tags.split(',')
+        matching_notes = self.notes_manager.search_notes_by_tags(tags, match_all=mode == "and")
+        joined = f" {mode} ".join(tags)
+        if matching_notes:
+            lines = [f"ID: {note.id}, Content: {note.content}, Tags: {note.tags}" for note in matching_notes]
+            return f"Matching notes for tags {joined}:\n" + "\n".join(lines)
+        else:
+            return f"No notes found for tags {joined}."
+
+    @COMMANDS.command("grep-notes", args="*pattern", help="List notes whose content matches a regular expression")
+    def grep_notes(self, pattern):
+        try:
+            re.compile(pattern)
+        except re.error as e:
+            raise ValueError(f"Invalid pattern: {e}")
+        notes = self.notes_manager.notes
+        matching_notes = [notes[note_id] for note_id in self.notes_manager.scan(match_note, pattern)]
+        if matching_notes:
+            lines = [f"ID: {note.id}, Content: {note.content}, Tags: {note.tags}" for note in matching_notes]
+            return f"Notes matching /{pattern}/:\n" + "\n".join(lines)
+        else:
+            return f"No notes match /{pattern}/."
+
+    @COMMANDS.command("search-notes", args="*query", help="Rank notes by keyword relevance")
+    def search_notes(self, query):
+        results = self.notes_manager.search_notes(query)
+        if results:
+            lines = [f"ID: {note.id}, Content: {note.content}, Tags: {note.tags}, Score: {score:.2f}" for note, score in results]
+            return f"Notes matching '{query}':\n" + "\n".join(lines)
+        else:
+            return f"No notes found for '{query}'."
+
+
+PERF.watch(AddressBook, 'load_from_file', 'save_to_file')
+PERF.watch(
+    NotesManager, 'load_from_file', 'save_to_file', 'add_note', 'delete_note', 'delete_notes_by_tag',
+    'search_notes_by_tag', 'search_notes_by_tags', 'search_notes',
+)
+
+
+# Every writing command closes one undo step
+COMMANDS.after_write = lambda assistant: assistant.history.commit()
+
+
+def handle_command(user_input, assistant):
+    return COMMANDS.dispatch(assistant, user_input)
+
+def run_batch(assistant, lines, out, save_every=0):
+    # Runs a script of commands, one per line ('#' starts a comment). Results
+    # go to `out` (None discards them) and contacts/notes are saved every
+    # save_every commands and once at the end. Returns {command: [count, seconds]}.
+    stats = defaultdict(lambda: [0, 0.0])
+    executed = 0
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        started = time.perf_counter()
+        result = handle_command(line, assistant)
+        # Streamed results run as they are consumed, so they are consumed
+        # (and timed) even when discarded
+        if out is not None:
+            write_result(result, out)
+        elif not isinstance(result, str):
+            for _ in result:
+                pass
+        entry = stats[line.split()[0].lower()]
+        entry[0] += 1
+        entry[1] += time.perf_counter() - started
+        if result == "Good bye!":
+            return stats
+        executed += 1
+        if save_every and executed % save_every == 0:
+            assistant.save()
+    assistant.save()
+    return stats
+
+def format_throughput(stats):
+    lines = [f"{'command':<24}{'count':>10}{'seconds':>10}{'per second':>14}"]
+    for command, (count, seconds) in sorted(stats.items(), key=lambda item: -item[1][1]):
+        rate = count / seconds if seconds else float('inf')
+        lines.append(f"{command:<24}{count:>10}{seconds:>10.3f}{rate:>14.0f}")
+    return "\n".join(lines)
+
+def parse_arguments(argv):
+    parser = argparse.ArgumentParser(description="Personal assistant for contacts and notes.")
+    parser.add_argument("--data-dir", default="assistant_data", help="directory holding contacts and notes")
+    parser.add_argument("--batch", metavar="FILE", help="run commands from FILE ('-' for stdin) instead of prompting")
+    parser.add_argument("--save-every", type=int, default=0, metavar="N", help="in batch mode, also save every N commands")
+    parser.add_argument("--quiet", action="store_true", help="in batch mode, do not print command results")
+    parser.add_argument("--serve", metavar="ADDRESS", help="serve commands to many clients on HOST:PORT or a Unix socket path")
+    parser.add_argument("--workers", type=int, default=4, metavar="N", help="in server mode, threads running commands")
+    parser.add_argument("--shards", type=int, default=0, metavar="N", help="split contacts over N files by name (kept from then on)")
+    parser.add_argument("--shard-budget", type=float, default=256, metavar="MB", help="memory for open contact shards")
+    parser.add_argument("--perf", action="store_true", help="time commands from the start (see 'stats perf')")
+    parser.add_argument("--slow-ms", type=float, default=100, metavar="MS", help="log commands slower than MS milliseconds")
+    parser.add_argument("--slow-log", metavar="FILE", help="also append slow commands to FILE")
+    parser.add_argument("--startup-profile", action="store_true", help="print the time spent in each startup phase to stderr")
+    return parser.parse_args(argv)
+
+class StartupProfile:
+    # Wall time per startup phase, counted from the import of this module
+    def __init__(self):
+        self.last = IMPORT_STARTED
+        self.phases = []
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        self.phases.append((phase, now - self.last))
+        self.last = now
 
-def handle_command(user_input, assistant, filename):
-    command, *args = user_input.split()
-    command = command.lower()
+    def report(self):
+        phases = ", ".join(f"{phase} {seconds * 1e3:.1f} ms" for phase, seconds in self.phases)
+        return f"Startup: {phases}; {(self.last - IMPORT_STARTED) * 1e3:.1f} ms in all"
 
-    if command in ["close", "exit"]:
-        assistant.address_book.save_to_file(filename)
-        return "Good bye!"
-    elif command == "hello":
-        return "How can I help you?"
-    elif command == "save":
-        assistant.address_book.save_to_file(filename)
-        return "Address book saved."
-    elif command == "load":
-        assistant.address_book = AddressBook.load_from_file(filename)
-        return "Address book loaded."
-    elif command == "add":
-        return assistant.add_contact(args, assistant.address_book)
-    elif command == "change":
-        return assistant.change_contact(args, assistant.address_book)
-    elif command == "phone":
-        return assistant.get_phone(args, assistant.address_book)
-    elif command == "all":
-        return assistant.display_all(assistant.address_book)
-    elif command == "add-birthday":
-        return assistant.add_birthday(args, assistant.address_book.data)
-    elif command == "show-birthday":
-        return assistant.show_birthday(args, assistant.address_book)
-    elif command == "birthdays":
-        return assistant.birthdays(assistant.address_book)
-    elif command == "add-note":
-        content = ' '.join(args[:-1])
-        tags = args[-1].split(',')
-        return assistant.add_note(content, tags)
-    elif command == "delete-notes-by-tag":
-        return assistant.delete_notes_by_tag(args[0])
-    elif command == "search-notes-by-tag":
-        return assistant.search_notes_by_tag(args[0])
-    else:
-        return "Invalid command."
+    @staticmethod
+    def loaded(seconds):
+        # Called on the loading thread
+        print(f"Startup: contacts loaded in the background in {seconds * 1e3:.1f} ms", file=sys.stderr)
 
 def main():   
-    filename = "address_book.pkl"
-    assistant = PersonalAssistant()
-    assistant.address_book = AddressBook.load_from_file(filename)
+    if len(sys.argv) == 4 and sys.argv[1] == "convert":
+        convert_legacy(sys.argv[2], sys.argv[3])
+        print(f"Converted {sys.argv[2]} to {sys.argv[3]}.")
+        return
+    profile = StartupProfile()
+    profile.mark("imports")
+    options = parse_arguments(sys.argv[1:])
+    profile.mark("arguments")
+    PERF.slow_threshold = options.slow_ms / 1e3
+    PERF.slow_path = options.slow_log
+    if options.perf:
+        PERF.enable(COMMANDS)
+    storage = StorageEngine(options.data_dir, options.shards, int(options.shard_budget * (1 << 20)))
+    contacts = storage.path(PersonalAssistant.CONTACTS)
+    if not os.path.exists(contacts) and not storage.is_sharded(PersonalAssistant.CONTACTS) and os.path.exists("address_book.pkl"):
+        convert_legacy("address_book.pkl", contacts)
+    assistant = PersonalAssistant(storage)
+    profile.mark("storage")
+
+    if options.batch or options.serve:
+        assistant.load()
+        profile.mark("contacts")
+        if options.startup_profile:
+            print(profile.report(), file=sys.stderr)
+
+    if options.batch:
+        # Saves are explicit in batch mode, so journal writes can stay buffered
+        JournaledFile.autoflush = False
+        source = sys.stdin if options.batch == "-" else open(options.batch, encoding="utf-8")
+        with source:
+            stats = run_batch(assistant, source, None if options.quiet else sys.stdout, options.save_every)
+        assistant.close()
+        sys.stdout.flush()
+        print(format_throughput(stats), file=sys.stderr)
+        return
+
+    if options.serve:
+        from server import serve
+
+        # Open the notes segment up front rather than on a worker thread
+        assistant.notes_manager
+        serve(assistant, COMMANDS, assistant.save, options.serve, options.workers)
+        assistant.save()
+        assistant.close()
+        return
+
+    # The prompt does not wait for the contacts; the first command that
+    # needs them does
+    assistant.load_in_background(profile.loaded if options.startup_profile else None)
     print("Welcome to the assistant bot!")
-    
+    profile.mark("prompt")
+    if options.startup_profile:
+        print(profile.report(), file=sys.stderr)
+
     while True:
         user_input = input("Enter a command: ")
-        result = handle_command(user_input, assistant, filename)
-        print(result)
+        result = handle_command(user_input, assistant)
+        write_result(result, sys.stdout)
         if result == "Good bye!":
             break
 
@@ -0,0 +1,57 @@
+import random
+
+FIRST_NAMES = ['Anna', 'Bohdan', 'Daria', 'Ivan', 'Kateryna', 'Maksym', 'Olena', 'Petro', 'Sofia', 'Taras']
+LAST_NAMES = ['Bondar', 'Kovalenko', 'Kravets', 'Melnyk', 'Moroz', 'Shevchenko', 'Tkachenko', 'Zhuk']
+STREETS = ['Khreshchatyk', 'Sahaidachnoho', 'Shevchenka', 'Franka', 'Lesi Ukrainky']
+
+
+def contact_states(count, seed=0):
+    # Synthetic contacts in Record.to_state() layout: (name, phones, emails, addresses, birthday)
+    rng = random.Random(seed)
+    for i in range(count):
+        name = f"{rng.choice(FIRST_NAMES)}{rng.choice(LAST_NAMES)}{i}"
+        phones = [f"0{rng.randrange(10 ** 9):09d}" for _ in range(rng.choice((1, 1, 1, 2)))]
+        emails = [f"{name.lower()}@example.com"] if rng.random() < 0.5 else []
+        addresses = [f"{rng.randrange(1, 200)} {rng.choice(STREETS)} St"] if rng.random() < 0.3 else []
+        birthday = None
+        if rng.random() < 0.7:
+            birthday = f"{rng.randrange(1, 29):02d}.{rng.randrange(1, 13):02d}.{rng.randrange(1950, 2010)}"
+        yield (name, phones, emails, addresses, birthday)
+
+
+TAGS = ['work', 'home', 'family', 'travel', 'shopping', 'ideas', 'urgent', 'later', 'health', 'finance',
+        'books', 'music', 'sport', 'birthday', 'project', 'meeting', 'call', 'email', 'garden', 'car']
+WORDS = ['call', 'buy', 'send', 'check', 'plan', 'book', 'meet', 'pay', 'read', 'write',
+         'milk', 'report', 'tickets', 'doctor', 'invoice', 'gift', 'hotel', 'train', 'keys', 'notes']
+
+
+def note_states(count, seed=0):
+    # Synthetic notes in Note.to_state() layout: (id, content, tags)
+    rng = random.Random(seed)
+    for note_id in range(1, count + 1):
+        content = ' '.join(rng.choice(WORDS) for _ in range(rng.randrange(3, 12)))
+        yield (note_id, content, rng.sample(TAGS, rng.randrange(1, 4)))
+
+
+def write_data_dir(directory, contacts, notes, seed=0):
+    # A data directory as PersonalAssistant(StorageEngine(directory)) loads
+    # it, written straight to snapshots. Returns the contact names.
+    from assistant import NotesManager, PersonalAssistant
+    from storage import IndexedFile, StorageEngine, encode_state
+
+    storage = StorageEngine(directory)
+    names = []
+
+    def contact_items():
+        for state in contact_states(contacts, seed):
+            names.append(state[0])
+            yield state[0], encode_state(state)
+
+    def note_items():
+        for state in note_states(notes, seed):
+            yield str(state[0]), encode_state(state)
+        yield NotesManager.NEXT_ID_KEY, encode_state(notes + 1)
+
+    IndexedFile.write(storage.path(PersonalAssistant.CONTACTS), contact_items())
+    IndexedFile.write(storage.path(PersonalAssistant.NOTES), note_items())
+    return names
@@ -0,0 +1,78 @@
+# Load generator for server mode: many concurrent clients sending a mix of
+# reads and writes, reporting throughput and latency percentiles.
+# Start a server first, e.g.
+#   python assistant.py --data-dir /tmp/load --serve 127.0.0.1:8765
+#   python -m benchmarks.load --address 127.0.0.1:8765 --clients 32
+import argparse
+import asyncio
+import random
+import time
+
+from server import open_connection, read_response
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def commands(client, count, write_ratio, save_every, seed):
+    rng = random.Random(seed + client)
+    names = []
+    for number in range(count):
+        if save_every and number % save_every == save_every - 1:
+            yield "save"
+        elif not names or rng.random() < write_ratio:
+            name = f"load{client}x{number}"
+            names.append(name)
+            yield f"add {name} {rng.randrange(10 ** 10):010d}"
+        else:
+            yield rng.choice((
+                f"phone {rng.choice(names)}",
+                f"search load{client}x{rng.randrange(len(names))}",
+                f"find-by-phone {rng.randrange(10 ** 4):04d}",
+                "all --limit 10",
+            ))
+
+
+async def client(address, script, latencies):
+    reader, writer = await open_connection(address)
+    await read_response(reader)
+    for command in script:
+        started = time.perf_counter()
+        writer.write(f"{command}\n".encode())
+        await writer.drain()
+        await read_response(reader)
+        latencies.append(time.perf_counter() - started)
+    writer.write(b"exit\n")
+    await writer.drain()
+    await read_response(reader)
+    writer.close()
+
+
+async def run(options):
+    latencies = []
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        client(options.address, commands(number, options.requests, options.writes, options.save_every, options.seed), latencies)
+        for number in range(options.clients)
+    ))
+    return time.perf_counter() - started, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure server throughput and latency.")
+    parser.add_argument("--address", default="127.0.0.1:8765", help="HOST:PORT or Unix socket path of the server")
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=1000, help="commands per client")
+    parser.add_argument("--writes", type=float, default=0.2, help="fraction of commands that add a contact")
+    parser.add_argument("--save-every", type=int, default=0, metavar="N", help="each client also saves every N commands")
+    parser.add_argument("--seed", type=int, default=0)
+    options = parser.parse_args()
+    seconds, latencies = asyncio.run(run(options))
+    print(f"{len(latencies)} commands from {options.clients} clients in {seconds:.2f}s: {len(latencies) / seconds:.0f} commands/s")
+    print(f"latency p50 {percentile(latencies, 0.5) * 1000:.2f} ms, p99 {percentile(latencies, 0.99) * 1000:.2f} ms, max {max(latencies) * 1000:.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+# Bytes per contact for the slotted Record layout against the previous one.
+# Run from the repository root: python -m benchmarks.memory --count 1000000
+import argparse
+import gc
+import tracemalloc
+
+from assistant import Record
+from benchmarks.data import contact_states
+
+
+# The layout Record had before __slots__: a __dict__ per object, a Field
+# object per value and a list per collection.
+class LegacyField:
+    def __init__(self, value):
+        self.value = value
+
+
+class LegacyRecord:
+    def __init__(self, state):
+        name, phones, emails, addresses, birthday = state
+        self.name = LegacyField(name)
+        self.phones = [LegacyField(phone) for phone in phones]
+        self.emails = [LegacyField(email) for email in emails]
+        self.addresses = [LegacyField(address) for address in addresses]
+        self.birthday = birthday
+
+
+def bytes_per_contact(build, count):
+    gc.collect()
+    tracemalloc.start()
+    # States are generated inside the traced region so the strings each
+    # layout keeps alive are counted too
+    records = [build(state) for state in contact_states(count)]
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del records
+    return current / count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare Record memory use before and after __slots__.")
+    parser.add_argument('--count', type=int, default=1_000_000)
+    args = parser.parse_args()
+
+    before = bytes_per_contact(LegacyRecord, args.count)
+    after = bytes_per_contact(Record.from_state, args.count)
+    print(f"contacts: {args.count}")
+    print(f"before: {before:.0f} bytes/contact")
+    print(f"after:  {after:.0f} bytes/contact ({before / after:.2f}x smaller)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+# Save and load throughput of the binary formats against pickle.
+# Run from the repository root: python -m benchmarks.serialization --counts 10000 100000 1000000
+import argparse
+import os
+import pickle
+import tempfile
+import time
+
+import archive
+from benchmarks.data import contact_states
+from storage import IndexedFile, decode_state, encode_state
+
+
+def pickle_save(path, states):
+    with open(path, 'wb') as file:
+        pickle.dump({state[0]: state for state in states}, file, pickle.HIGHEST_PROTOCOL)
+
+
+def pickle_load(path):
+    with open(path, 'rb') as file:
+        return len(pickle.load(file))
+
+
+def snapshot_save(path, states):
+    IndexedFile.write(path, ((state[0], encode_state(state)) for state in states))
+
+
+def snapshot_load(path):
+    store = IndexedFile(path)
+    count = sum(1 for _, payload in store.items() if decode_state(payload))
+    store.close()
+    return count
+
+
+def archive_save(compression):
+    def save(path, states):
+        with archive.ArchiveWriter(path, compression) as writer:
+            for state in states:
+                writer.write(state[0], encode_state(state))
+
+    return save
+
+
+def archive_load(path):
+    return sum(1 for _, payload in archive.read_archive(path) if decode_state(payload))
+
+
+FORMATS = [
+    ("pickle", pickle_save, pickle_load),
+    ("snapshot", snapshot_save, snapshot_load),
+    ("archive", archive_save('none'), archive_load),
+    ("archive, zlib", archive_save('zlib'), archive_load),
+]
+if archive.zstandard is not None:
+    FORMATS.append(("archive, zstd", archive_save('zstd'), archive_load))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure save and load throughput per format.")
+    parser.add_argument("--counts", type=int, nargs="+", default=[10000, 100000, 1000000], help="contacts per run")
+    options = parser.parse_args()
+    print(f"{'contacts':>9}  {'format':<15}{'MB':>8}{'save/s':>12}{'load/s':>12}")
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'book')
+        for count in options.counts:
+            states = list(contact_states(count))
+            for label, save, load in FORMATS:
+                start = time.perf_counter()
+                save(path, states)
+                saved = time.perf_counter()
+                assert load(path) == count
+                loaded = time.perf_counter()
+                size = os.path.getsize(path) / 1e6
+                print(f"{count:>9}  {label:<15}{size:>8.1f}{count / (saved - start):>12,.0f}{count / (loaded - saved):>12,.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,231 @@
+# Times every command and both persistence directions on synthetic contacts
+# and notes, and compares the results with a stored baseline.
+# Run from the repository root:
+#   python -m benchmarks.suite --sizes 1000 100000 --output baseline.json
+#   python -m benchmarks.suite --sizes 1000 100000 --baseline baseline.json
+# The exit status is 1 when a result regressed against the baseline.
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from assistant import COMMANDS, PersonalAssistant, handle_command
+from benchmarks.data import TAGS, WORDS, contact_states, write_data_dir
+from benchmarks.load import percentile
+from exchange import write_csv
+from storage import StorageEngine
+
+IMPORT_SIZE = 1000
+# Regressions smaller than this are timer noise, whatever the ratio
+MIN_DELTA_MS = 0.05
+# Whole-book commands; they run --heavy-repeat times instead of --repeat
+HEAVY = {
+    'all', 'filter', 'stats', 'report', 'birthdays', 'export', 'import', 'load', 'grep-notes',
+    'search-notes-by-tag', 'search-notes-by-tags', 'persist:load', 'persist:save',
+}
+
+
+class Context:
+    # What command lines are made from: the generated names, a file to
+    # import and a scratch directory. Sample i of every writing command
+    # touches its own contact or note.
+    def __init__(self, size, names, directory, seed):
+        self.size = size
+        self.names = names
+        self.directory = directory
+        self.rng = random.Random(seed)
+        self.import_path = os.path.join(directory, 'import.csv')
+        write_csv(self.import_path, contact_states(IMPORT_SIZE, seed + 1))
+
+    def name(self):
+        return self.rng.choice(self.names)
+
+    def phone(self):
+        return f"0{self.rng.randrange(10 ** 9):09d}"
+
+    def words(self, count):
+        return ' '.join(self.rng.choice(WORDS) for _ in range(count))
+
+
+# (label, command line for sample i); reads first, then writes, so reads
+# see the generated data only
+COMMAND_LINES = [
+    ('hello', lambda c, i: "hello"),
+    ('help', lambda c, i: "help"),
+    ('phone', lambda c, i: f"phone {c.name()}"),
+    ('show-birthday', lambda c, i: f"show-birthday {c.name()}"),
+    ('find-by-phone', lambda c, i: f"find-by-phone {c.phone()[:5]}"),
+    ('search', lambda c, i: f"search {c.name()[:6]}"),
+    ('search fuzzy', lambda c, i: f"search {c.name()[1:]}"),
+    ('all --limit', lambda c, i: f"all --limit 20 --offset {c.rng.randrange(c.size)}"),
+    ('all', lambda c, i: "all"),
+    ('filter', lambda c, i: f"filter month {c.rng.randrange(1, 13)}"),
+    ('stats', lambda c, i: "stats"),
+    ('stats perf', lambda c, i: "stats perf"),
+    ('report', lambda c, i: "report months"),
+    ('birthdays', lambda c, i: "birthdays 7"),
+    ('search-notes', lambda c, i: f"search-notes {c.words(2)}"),
+    ('search-notes-by-tag', lambda c, i: f"search-notes-by-tag {c.rng.choice(TAGS)}"),
+    ('search-notes-by-tags', lambda c, i: f"search-notes-by-tags {','.join(c.rng.sample(TAGS, 2))} and"),
+    ('grep-notes', lambda c, i: f"grep-notes {c.words(1)}"),
+    ('export', lambda c, i: f"export csv {os.path.join(c.directory, 'export.csv')}"),
+    ('import', lambda c, i: f"import csv {c.import_path}"),
+    ('add', lambda c, i: f"add Bench{i} {c.phone()}"),
+    ('change', lambda c, i: f"change Bench{i} {c.phone()}"),
+    ('add-birthday', lambda c, i: f"add-birthday Bench{i} 01.02.1990"),
+    ('add-note', lambda c, i: f"add-note benchmark note {i} bench{i}"),
+    ('edit-note', lambda c, i: f"edit-note {c.size - i} edited {c.words(3)}"),
+    ('delete-notes-by-tag', lambda c, i: f"delete-notes-by-tag bench{i}"),
+    ('delete-note', lambda c, i: f"delete-note {i + 1}"),
+    ('delete', lambda c, i: f"delete Bench{i}"),
+    ('snapshot', lambda c, i: f"snapshot bench{i}"),
+    ('undo', lambda c, i: "undo"),
+    ('redo', lambda c, i: "redo"),
+    ('restore', lambda c, i: f"restore bench{i}"),
+    ('save', lambda c, i: "save"),
+    ('load', lambda c, i: "load"),
+]
+# exit/close end the session, persist:save covers what they do; perf would
+# instrument the runs that follow it
+SKIPPED = {'exit', 'perf'}
+
+
+def run_command(assistant, line):
+    result = handle_command(line, assistant)
+    if not isinstance(result, str):
+        for _ in result:
+            pass
+
+
+def measure(function, samples):
+    # Call 0 runs under tracemalloc for the peak memory and doubles as the
+    # warm-up; calls 1..samples are timed
+    tracemalloc.start()
+    function(0)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    times = []
+    for number in range(1, samples + 1):
+        started = time.perf_counter()
+        function(number)
+        times.append(time.perf_counter() - started)
+    return {
+        'samples': samples,
+        'ops_per_s': samples / sum(times),
+        'p50_ms': percentile(times, 0.5) * 1e3,
+        'p99_ms': percentile(times, 0.99) * 1e3,
+        'peak_kib': peak / 1024,
+    }
+
+
+def load_assistant(data_dir):
+    assistant = PersonalAssistant(StorageEngine(data_dir))
+    assistant.load()
+    assistant.notes_manager
+    return assistant
+
+
+def run_size(size, options, directory):
+    data_dir = os.path.join(directory, f"data{size}")
+    names = write_data_dir(data_dir, size, size, options.seed)
+    context = Context(size, names, directory, options.seed)
+    results = {}
+
+    def samples(label):
+        return options.heavy_repeat if label.split()[0] in HEAVY else options.repeat
+
+    results['persist:load'] = measure(lambda _: load_assistant(data_dir).close(), samples('persist:load'))
+    assistant = load_assistant(data_dir)
+    for label, line in COMMAND_LINES:
+        lines = [line(context, number) for number in range(samples(label) + 1)]
+        results[label] = measure(lambda number: run_command(assistant, lines[number]), len(lines) - 1)
+        print(f"  {size:>9} {label}", file=sys.stderr)
+
+    def save(number):
+        # A full rewrite of both segments, alternating between two targets
+        target = StorageEngine(os.path.join(directory, f"save{number % 2}"))
+        assistant.address_book.save_to_file(target.path(PersonalAssistant.CONTACTS))
+        assistant.notes_manager.save_to_file(target.path(PersonalAssistant.NOTES))
+        assistant.address_book.journal.wait()
+        assistant.notes_manager.journal.wait()
+
+    results['persist:save'] = measure(save, samples('persist:save'))
+    assistant.close()
+    return results
+
+
+def compare(results, baseline, tolerance):
+    # Lines describing every p50 or peak memory result that is more than
+    # `tolerance` worse than the baseline's
+    regressions = []
+    for size, commands in results.items():
+        for label, metrics in commands.items():
+            before = baseline.get('results', {}).get(size, {}).get(label)
+            if before is None:
+                continue
+            if metrics['p50_ms'] > before['p50_ms'] * (1 + tolerance) and metrics['p50_ms'] - before['p50_ms'] > MIN_DELTA_MS:
+                regressions.append(f"{size} {label}: p50 {before['p50_ms']:.3f} -> {metrics['p50_ms']:.3f} ms")
+            if metrics['peak_kib'] > before['peak_kib'] * (1 + tolerance) and metrics['peak_kib'] - before['peak_kib'] > 64:
+                regressions.append(f"{size} {label}: peak {before['peak_kib']:.0f} -> {metrics['peak_kib']:.0f} KiB")
+    return regressions
+
+
+def format_results(results):
+    lines = [f"{'contacts':>9}  {'command':<22}{'samples':>8}{'ops/s':>12}{'p50 ms':>10}{'p99 ms':>10}{'peak KiB':>11}"]
+    for size, commands in results.items():
+        for label, metrics in commands.items():
+            lines.append(
+                f"{size:>9}  {label:<22}{metrics['samples']:>8}{metrics['ops_per_s']:>12,.0f}"
+                f"{metrics['p50_ms']:>10.3f}{metrics['p99_ms']:>10.3f}{metrics['peak_kib']:>11,.0f}"
+            )
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark every command and the persistence paths.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 100000], help="contacts (and notes) per run, e.g. 1000 100000 1000000")
+    parser.add_argument("--repeat", type=int, default=200, help="timed samples per command")
+    parser.add_argument("--heavy-repeat", type=int, default=5, help="timed samples per whole-book command")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", metavar="FILE", help="write the results as JSON, e.g. to store a baseline")
+    parser.add_argument("--baseline", metavar="FILE", help="compare with results written by --output")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown or memory growth, as a fraction")
+    options = parser.parse_args()
+
+    missing = {entry.name for entry in COMMANDS.commands.values()} - SKIPPED - {label.split()[0] for label, _ in COMMAND_LINES}
+    if missing:
+        parser.error(f"no benchmark for: {', '.join(sorted(missing))}")
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for size in options.sizes:
+            results[str(size)] = run_size(size, options, directory)
+    print(format_results(results))
+
+    report = {
+        'meta': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'repeat': options.repeat,
+            'heavy_repeat': options.heavy_repeat,
+            'seed': options.seed,
+        },
+        'results': results,
+    }
+    if options.output:
+        with open(options.output, 'w', encoding='utf-8') as file:
+            json.dump(report, file, indent=2)
+    if options.baseline:
+        with open(options.baseline, encoding='utf-8') as file:
+            regressions = compare(results, json.load(file), options.tolerance)
+        print("\n".join(["Regressions:", *regressions]) if regressions else "No regressions.")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
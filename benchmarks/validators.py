@@ -0,0 +1,50 @@
+# Cost per field of the validators against the checks they replaced.
+# Run from the repository root: python -m benchmarks.validators
+import argparse
+from datetime import datetime
+import timeit
+
+from validators import parse_birthday, parse_email, parse_phone, validate_many
+
+
+def strptime_birthday(value):
+    return datetime.strptime(value, '%d.%m.%Y').date()
+
+
+def digits_phone(value):
+    return len(value) == 10 and value.isdigit()
+
+
+CASES = [
+    ("phone, 10 digits", parse_phone, "0501234567"),
+    ("phone, formatted", parse_phone, "+38 (050) 123-45-67"),
+    ("phone, international", parse_phone, "+44 20 7946 0958"),
+    ("phone, previous check", digits_phone, "0501234567"),
+    ("email", parse_email, "john.doe@example.com"),
+    ("birthday", parse_birthday, "15.03.1990"),
+    ("birthday, strptime", strptime_birthday, "15.03.1990"),
+]
+
+
+def nanoseconds(function, argument, number):
+    timer = timeit.Timer(lambda: function(argument))
+    return min(timer.repeat(5, number)) / number * 1e9
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure validator cost per field.")
+    parser.add_argument("--number", type=int, default=200000, help="calls per measurement")
+    options = parser.parse_args()
+    # The empty call is the loop and lambda overhead every row includes
+    overhead = nanoseconds(lambda value: None, None, options.number)
+    print(f"{'validator':<26}{'ns/field':>10}")
+    for label, function, value in CASES:
+        print(f"{label:<26}{nanoseconds(function, value, options.number) - overhead:>10.0f}")
+    phones = [f"{number:010d}" for number in range(10000)]
+    timer = timeit.Timer(lambda: validate_many(parse_phone, phones))
+    batch = min(timer.repeat(5, 20)) / 20 / len(phones) * 1e9
+    print(f"{'validate_many, phones':<26}{batch:>10.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+import calendar
+from collections import defaultdict
+from datetime import timedelta
+
+# The birthday index shared by assistant.py and bot.py, and the weekly
+# greeting list both build from it.
+
+
+class BirthdayIndex:
+    # Contact names bucketed by the day of the year they celebrate on, using
+    # a leap-year calendar so 29 February has its own bucket. "Next N days"
+    # visits at most N buckets instead of parsing every birthday in the book.
+    MONTH_STARTS = (0, 31, 60, 91, 121, 152, 182, 213, 244, 274, 305, 335)
+
+    def __init__(self, entries=()):
+        self.buckets = [set() for _ in range(366)]
+        self.slots = {}
+        for name, birthday in entries:
+            self.update(name, birthday)
+
+    @classmethod
+    def slot(cls, month, day):
+        return cls.MONTH_STARTS[month - 1] + day - 1
+
+    def update(self, name, birthday):
+        # birthday is a date, or None to drop the contact from the index
+        old = self.slots.pop(name, None)
+        if old is not None:
+            self.buckets[old].discard(name)
+        if birthday is not None:
+            slot = self.slot(birthday.month, birthday.day)
+            self.buckets[slot].add(name)
+            self.slots[name] = slot
+
+    def upcoming(self, start, days):
+        # (date, name) pairs for the `days` days beginning with start
+        seen = set()
+        for offset in range(days):
+            day = start + timedelta(days=offset)
+            slots = [self.slot(day.month, day.day)]
+            if day.month == 2 and day.day == 28 and not calendar.isleap(day.year):
+                # 29 February birthdays are celebrated on the 28th in common years
+                slots.append(slots[0] + 1)
+            if slots[0] in seen:
+                break
+            seen.update(slots)
+            for name in sorted(set().union(*(self.buckets[slot] for slot in slots))):
+                yield day, name
+
+
+def birthdays_per_week(index, today):
+    # "Weekday: names" lines for the next 7 days, starting with today
+    by_weekday = defaultdict(list)
+    for day, name in index.upcoming(today, 7):
+        # Weekend birthdays are greeted on the following Monday
+        weekday = day.weekday() if day.weekday() < 5 else 0
+        by_weekday[weekday].append(name)
+    order = sorted(by_weekday, key=lambda weekday: (weekday - today.weekday()) % 7)
+    return [f"{calendar.day_name[weekday]}: {', '.join(by_weekday[weekday])}" for weekday in order]
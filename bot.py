@@ -1,6 +1,12 @@
 from datetime import datetime, timedelta
+from itertools import chain, islice
+import os
+import sys
 
-import pickle
+from birthdays import BirthdayIndex, birthdays_per_week
+from commands import CommandRegistry, parse_options, write_result
+from storage import JournaledFile, LazyMapping, convert_legacy, decode_state, encode_state, legacy_state
+from validators import format_phone, parse_birthday, parse_phone
 
 class Field:
     def __init__(self, value):
@@ -14,43 +20,79 @@ class Name(Field):
 
 class Phone(Field):
     def __init__(self, value):
-        if not self.validate(value):
-            raise ValueError("Invalid phone number format")
-        super().__init__(value)
+        super().__init__(format_phone(parse_phone(value)))
 
     def validate(self, value):
-        return len(value) == 10 and value.isdigit()
+        try:
+            parse_phone(value)
+        except ValueError:
+            return False
+        return True
 
 class Birthday(Field):
     def __init__(self, value=None):
-        if value and not self.validate(value):
-            raise ValueError("Invalid birthday format. Use DD.MM.YYYY")
+        self.date = parse_birthday(value) if value else None
         super().__init__(value)
 
     def validate(self, value):
-        # Add validation logic for DD.MM.YYYY format
-        pass
+        try:
+            parse_birthday(value)
+        except ValueError:
+            return False
+        return True
+
+    @classmethod
+    def restore(cls, value):
+        # Stored birthdays predate validation; keep unparseable ones as text
+        try:
+            return cls(value)
+        except ValueError:
+            birthday = cls()
+            birthday.value = value
+            return birthday
+
+def format_contact(state):
+    # Renders a Record state, so listings need not build Records
+    name, phones, birthday = state
+    return f"Contact name: {name}, phones: {'; '.join(phones)}, birthday: {birthday or 'Birthday not set.'}"
 
 class Record:
     def __init__(self, name):
         self.name = Name(name)
         self.phones = []
         self.birthday = None  # Add birthday attribute to Record
+        self.book = None
+        self.rendered = None  # str() until the next change
+
+    def _changed(self):
+        self.rendered = None
+        if self.book is not None:
+            self.book.record_changed(self)
 
     def add_phone(self, phone):
         self.phones.append(Phone(phone))
+        self._changed()
 
     def delete_phone(self, phone):
+        phone = Phone(phone).value
         self.phones = [p for p in self.phones if p.value != phone]
+        self._changed()
 
     def edit_phone(self, old_phone, new_phone):
+        old_phone = Phone(old_phone).value
         for i, phone in enumerate(self.phones):
             if phone.value == old_phone:
                 self.phones[i] = Phone(new_phone)
+                self._changed()
                 break
 
+    def replace_phones(self, phone):
+        self.phones = [Phone(phone)]
+        self._changed()
+
     def add_birthday(self, birthday):
-        self.birthday = birthday
+        self.birthday = Birthday(birthday)
+        self._changed()
 
     def show_birthday(self):
         return str(self.birthday) if self.birthday else "Birthday not set."
@@ -58,27 +100,82 @@ class Record:
     # Add validation for birthday format if needed
 
     def __str__(self):
-        phones_str = '; '.join(str(phone) for phone in self.phones)
-        return f"Contact name: {self.name}, phones: {phones_str}, birthday: {self.show_birthday()}"
+        if self.rendered is None:
+            self.rendered = format_contact(self.to_state())
+        return self.rendered
+
+    def to_state(self):
+        return (
+            self.name.value,
+            [phone.value for phone in self.phones],
+            str(self.birthday) if self.birthday else None,
+        )
+
+    @classmethod
+    def from_state(cls, state):
+        # assistant.py records also carry emails and addresses
+        name, phones, *_, birthday = state
+        record = cls(name)
+        record.phones = [Phone(phone) for phone in phones]
+        record.birthday = Birthday.restore(birthday) if birthday else None
+        return record
 
 class AddressBook:
     def __init__(self):
-        self.data = {}
+        self.data = LazyMapping(self._decode, self._encode)
+        self.journal = None
+        self._birthday_index = None
+
+    def _decode(self, payload):
+        record = Record.from_state(decode_state(payload))
+        record.book = self
+        return record
+
+    def _encode(self, record):
+        return encode_state(record.to_state())
 
     # Other methods...
     @classmethod
     def load_from_file(cls, filename):
         address_book = cls()
-        try:
-            with open(filename, 'rb') as file:
-                address_book.data = pickle.load(file)
-        except FileNotFoundError:
-            pass
+        journal = JournaledFile(filename)
+        store, legacy, entries = journal.load()
+        address_book.data.store = store
+        # Old pickle files are migrated to the indexed format on open
+        for name, value in legacy.items():
+            address_book._put(Record.from_state(legacy_state(value)))
+        for op, name, state in entries:
+            if op == 'put':
+                address_book._put(Record.from_state(state))
+            elif name in address_book.data:
+                del address_book.data[name]
+        journal.open(address_book.data.snapshot_items, rewrite=bool(legacy))
+        address_book.journal = journal
         return address_book
 
+    def _put(self, record):
+        record.book = self
+        self.data[record.name.value] = record
+
     def save_to_file(self, filename):
-        with open(filename, 'wb') as file:
-            pickle.dump(self.data, file)
+        if self.journal is None or self.journal.filename != filename:
+            self.close()
+            journal = JournaledFile(filename)
+            journal.open(self.data.snapshot_items, rewrite=True)
+            self.journal = journal
+        self.journal.save(self.data.snapshot_items)
+
+    def close(self):
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
+    def record_changed(self, record):
+        self.data.mark_dirty(record.name.value)
+        if self._birthday_index is not None:
+            self._birthday_index.update(record.name.value, record.birthday.date if record.birthday else None)
+        if self.journal is not None:
+            self.journal.put(record.name.value, record.to_state())
 
     # def add_record(self, record):
     #     self.data[record.name.value] = record
@@ -89,21 +186,37 @@ class AddressBook:
         if record.name.value not in self.data:
             # If it doesn't exist, add the record
             self.data[record.name.value] = record
+            record.book = self
+            self.record_changed(record)
             return "Contact added."
         else:
             return f"Contact '{record.name.value}' already exists."
 
     def delete(self, name):
         if name in self.data:
+            self.data[name].book = None
             del self.data[name]
+            if self._birthday_index is not None:
+                self._birthday_index.update(name, None)
+            if self.journal is not None:
+                self.journal.delete(name)
 
     def find(self, name):
         if name in self.data:
             return self.data[name]
 
-    def get_birthdays_per_week(self):
-        # Implement logic to return birthdays in the next week
-        pass
+    @property
+    def birthday_index(self):
+        # Built from the stored states on first use, then kept up to date
+        if self._birthday_index is None:
+            self._birthday_index = BirthdayIndex(
+                (name, Birthday.restore(state[-1]).date)
+                for name, state in self.data.scan(decode_state, Record.to_state) if state[-1]
+            )
+        return self._birthday_index
+
+    def get_birthdays_per_week(self, today=None):
+        return birthdays_per_week(self.birthday_index, today or datetime.now().date())
 
     def __str__(self):
         return '\n'.join(str(record) for record in self.data.values())
@@ -115,142 +228,127 @@ def parse_input(user_input, book, filename):
     cmd = cmd.strip().lower()
     return cmd, args, book, filename
 
-def input_error(func):
-    def inner(*args, **kwargs):
-        try:
-            return func(*args, **kwargs)
-        except ValueError:
-            return "Give me name and phone please."
-        except KeyError as e:
-            return f"Error: Key '{e.args[0]}' does not exist."
-        except IndexError:
-            return "Error: Insufficient arguments."
-
-    return inner
-
-@input_error
-def add_contact(args, address_book):
-    if len(args) == 2:
-        name, phone = args
-        # address_book[name] = phone
-        record = Record(name)  # Create a Record instance with the provided name
-        record.add_phone(phone)  # Add the phone number to the Record
-        address_book.add_record(record)  # Add the Record to the AddressBook
-        return "Contact added."
-    else:
-        return "Invalid command format for adding a contact."
-
-@input_error
-def change_contact(args, address_book):
-    if len(args) == 2:
-        name, phone = args
-        record = address_book.find(name)
-        if record:
-            record.phones = [Phone(phone)]  # Update the phone number for the found record
-            return f"Phone number updated for {name}."
-        else:
-            return f"{name} does not exist in contacts."
+COMMANDS = CommandRegistry()
+
+class Session:
+    def __init__(self, book, filename):
+        self.book = book
+        self.filename = filename
+
+@COMMANDS.command("hello", help="Greet the bot")
+def hello(session):
+    return "How can I help you?"
+
+@COMMANDS.command("help", help="List available commands")
+def show_help(session):
+    return COMMANDS.help()
+
+@COMMANDS.command("save", help="Save the address book")
+def save(session):
+    try:
+        session.book.save_to_file(session.filename)
+    except OSError as e:
+        return f"Save failed: {e}"
+    return "Address book saved."
+
+@COMMANDS.command("load", help="Reload the address book from disk")
+def load(session):
+    session.book.close()
+    session.book = AddressBook.load_from_file(session.filename)
+    return "Address book loaded."
+
+@COMMANDS.command("exit", "close", help="Save and quit")
+def exit_bot(session):
+    # A failed save is reported and the session stays open; as in
+    # assistant.py, only if the final sync in close() fails as well
+    try:
+        session.book.save_to_file(session.filename)
+    except OSError:
+        pass
+    try:
+        session.book.close()
+    except OSError as e:
+        return f"Save failed: {e}"
+    return "Good bye!"
+
+@COMMANDS.command("add", args="name phone", help="Add a contact with a phone number")
+def add_contact(session, name, phone):
+    record = Record(name)  # Create a Record instance with the provided name
+    record.add_phone(phone)  # Add the phone number to the Record
+    return session.book.add_record(record)  # Add the Record to the AddressBook
+
+@COMMANDS.command("change", args="name phone", help="Replace a contact's phone numbers")
+def change_contact(session, name, phone):
+    record = session.book.find(name)
+    if record:
+        record.replace_phones(phone)  # Update the phone number for the found record
+        return f"Phone number updated for {name}."
     else:
-        return "Invalid command format for changing a contact's phone number."
-
-@input_error
-def get_phone(args, address_book):
-    if len(args) == 1:
-        name = args[0]
-        record = address_book.find(name)
-        if record:
-            return f"Phone number for {name}: {record.phones}"
-        else:
-            return f"{name} does not exist in contacts."
+        return f"{name} does not exist in contacts."
+
+@COMMANDS.command("phone", args="name", help="Show a contact's phone numbers")
+def get_phone(session, name):
+    record = session.book.find(name)
+    if record:
+        return f"Phone number for {name}: {'; '.join(str(phone) for phone in record.phones)}"
     else:
-        return "Invalid command format for retrieving a phone number."
-
-@input_error
-def display_all(address_book):
-    if address_book:
-        result = "All contacts:\n"
-        for record in address_book.data.values():
-            result += f"{str(record)}\n"
-        return result
+        return f"{name} does not exist in contacts."
+
+@COMMANDS.command("all", args="[*options]", help="Show contacts; options: --limit N --offset N")
+def display_all(session, options=''):
+    options = parse_options(options.split(), ('limit', 'offset'))
+    limit = int(options['limit']) if 'limit' in options else None
+    offset = int(options.get('offset', 0))
+    if session.book.data:
+        # Streamed from the stored states; records are not decoded or cached
+        states = islice(session.book.data.scan(decode_state, Record.to_state), offset, None if limit is None else offset + limit)
+        return chain(["All contacts:"], (format_contact(state) for _, state in states))
     else:
         return "No contacts available."
 
-@input_error
-def add_birthday(args, address_book):
-    if len(args) == 2:
-        name, birthday = args
-        print(name)
-        print(birthday)
-        record = address_book.find(name)
-        if record:
-            record.add_birthday(birthday)
-            return f"Birthday added for {name}."
-        else:
-            return f"{name} does not exist in the address book."
+@COMMANDS.command("add-birthday", args="name birthday", help="Set a contact's birthday")
+def add_birthday(session, name, birthday):
+    record = session.book.find(name)
+    if record:
+        record.add_birthday(birthday)
+        return f"Birthday added for {name}."
     else:
-        return "Invalid command format for adding a birthday."
-
-@input_error
-def show_birthday(args, address_book):
-    if len(args) == 1:
-        name = args[0]
-        record = address_book.find(name)
-        if record:
-            return f"Birthday for {name}: {record.show_birthday()}"
-        else:
-            return f"{name} does not exist in the address book."
+        return f"{name} does not exist in the address book."
+
+@COMMANDS.command("show-birthday", args="name", help="Show a contact's birthday")
+def show_birthday(session, name):
+    record = session.book.find(name)
+    if record:
+        return f"Birthday for {name}: {record.show_birthday()}"
     else:
-        return "Invalid command format for displaying a birthday."
+        return f"{name} does not exist in the address book."
 
-@input_error
-def birthdays(address_book):
-    upcoming_birthdays = address_book.get_birthdays_per_week()
+@COMMANDS.command("birthdays", help="Show birthdays in the next week")
+def birthdays(session):
+    upcoming_birthdays = session.book.get_birthdays_per_week()
     if upcoming_birthdays:
         return "Upcoming birthdays:\n" + "\n".join(upcoming_birthdays)
     else:
         return "No upcoming birthdays in the next week."
 
-def handle_command(user_input, book, filename):
-    command, *args = user_input.split()
-    command = command.lower()
-
-    if command in ["close", "exit"]:
-        book.save_to_file(filename)
-        return "Good bye!"
-    elif command == "hello":
-        return "How can I help you?"
-    elif command == "save":
-        book.save_to_file(filename)
-        return "Address book saved."
-    elif command == "load":
-        book = AddressBook.load_from_file(filename)
-        return "Address book loaded."
-    elif command == "add":
-        return add_contact(args, book.data)
-    elif command == "change":
-        return change_contact(args, book.data)
-    elif command == "phone":
-        return get_phone(args, book.data)
-    elif command == "all":
-        return display_all(book.data)
-    elif command == "add-birthday":
-        return add_birthday(args, book.data)
-    elif command == "show-birthday":
-        return show_birthday(args, book.data)
-    elif command == "birthdays":
-        return birthdays(book)
-    else:
-        return "Invalid command."
+def handle_command(user_input, session):
+    return COMMANDS.dispatch(session, user_input)
 
 def main():
-    filename = "address_book.pkl"
-    book = AddressBook.load_from_file(filename)
+    if len(sys.argv) == 4 and sys.argv[1] == "convert":
+        convert_legacy(sys.argv[2], sys.argv[3])
+        print(f"Converted {sys.argv[2]} to {sys.argv[3]}.")
+        return
+    filename = "address_book.db"
+    if not os.path.exists(filename) and os.path.exists("address_book.pkl"):
+        convert_legacy("address_book.pkl", filename)
+    session = Session(AddressBook.load_from_file(filename), filename)
     print("Welcome to the assistant bot!")
     
     while True:
         user_input = input("Enter a command: ")
-        result = handle_command(user_input, book, filename)
-        print(result)
+        result = handle_command(user_input, session)
+        write_result(result, sys.stdout)
         if result == "Good bye!":
             break
             
@@ -0,0 +1,97 @@
+from array import array
+from datetime import date
+
+from validators import INTERNATIONAL, MAX_PHONE_DIGITS, PHONE_DIGITS, parse_birthday, parse_phone, validate_many
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# A column-per-field copy of the contacts for aggregate reports. Each
+# contact is a row id into names; phones are flattened into one int64 array
+# with offsets marking where each contact's numbers start. Built on demand
+# and dropped by the address book on any change.
+
+NUMPY_MISSING = "Contact reports need NumPy: pip install numpy"
+
+
+def column_rows(name, state):
+    # Scan function for AddressBook.scan: one compact row per contact
+    _, phones, emails, _, birthday = state
+    day = month = ordinal = 0
+    if birthday:
+        try:
+            parsed = parse_birthday(birthday)
+            day, month, ordinal = parsed.day, parsed.month, parsed.toordinal()
+        except ValueError:
+            pass
+    yield name, validate_many(parse_phone, phones), len(emails), day, month, ordinal
+
+
+class ContactColumns:
+    def __init__(self, rows):
+        # Rows are appended to compact typed buffers first, so building never
+        # holds more than one Python object per contact (its name)
+        self.names = []
+        phones, offsets = array('q'), array('q', [0])
+        emails, days, months, ordinals = array('l'), array('B'), array('B'), array('q')
+        for name, numbers, email_count, day, month, ordinal in rows:
+            self.names.append(name)
+            phones.extend(numbers)
+            offsets.append(len(phones))
+            emails.append(email_count)
+            days.append(day)
+            months.append(month)
+            ordinals.append(ordinal)
+        self.phones = np.array(phones, dtype=np.int64)
+        self.offsets = np.array(offsets, dtype=np.int64)
+        self.phone_counts = np.diff(self.offsets)
+        self.email_counts = np.array(emails, dtype=np.int64)
+        self.day = np.array(days, dtype=np.uint8)
+        self.month = np.array(months, dtype=np.uint8)
+        self.ordinal = np.array(ordinals, dtype=np.int64)
+        # Contact id owning each entry of phones
+        self.phone_owner = np.repeat(np.arange(len(self.names)), self.phone_counts)
+
+    def __len__(self):
+        return len(self.names)
+
+    def summary(self, today=None):
+        today = today or date.today()
+        with_birthday = self.ordinal > 0
+        numbers, counts = np.unique(self.phones, return_counts=True)
+        ages = (today.toordinal() - self.ordinal[with_birthday]) / 365.2425
+        return [
+            ("Contacts", len(self)),
+            ("Phone numbers", len(self.phones)),
+            ("Contacts without a phone", int(np.count_nonzero(self.phone_counts == 0))),
+            ("Contacts with several phones", int(np.count_nonzero(self.phone_counts > 1))),
+            ("Numbers shared by several contacts", int(np.count_nonzero(counts > 1))),
+            ("Contacts with an email", int(np.count_nonzero(self.email_counts))),
+            ("Contacts with a birthday", int(np.count_nonzero(with_birthday))),
+            ("Average age", f"{ages.mean():.1f}" if len(ages) else "n/a"),
+        ]
+
+    def birthdays_per_month(self):
+        return np.bincount(self.month, minlength=13)[1:]
+
+    def phone_prefixes(self, digits=3, top=10):
+        # Most common leading digits of the numbers as displayed: local
+        # numbers and international ones ("+" prefixes) are counted apart
+        local = self.phones < INTERNATIONAL
+        international = self.phones[~local]
+        lengths = np.searchsorted(10 ** np.arange(MAX_PHONE_DIGITS + 1, dtype=np.int64), international, side='right')
+        found = []
+        for numbers, shown in (
+            (self.phones[local] // 10 ** (PHONE_DIGITS - digits), f"{{:0{digits}d}}"),
+            (international // 10 ** (lengths - digits), "+{}"),
+        ):
+            prefixes, counts = np.unique(numbers, return_counts=True)
+            order = np.argsort(-counts, kind='stable')[:top]
+            found.extend((shown.format(prefix), int(count)) for prefix, count in zip(prefixes[order], counts[order]))
+        found.sort(key=lambda item: -item[1])
+        return found[:top]
+
+    def without_phone(self):
+        return [self.names[i] for i in np.flatnonzero(self.phone_counts == 0)]
@@ -0,0 +1,143 @@
+import difflib
+from functools import wraps
+
+
+def input_error(func):
+    @wraps(func)
+    def inner(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        except ValueError as e:
+            return str(e) or "Give me name and phone please."
+        except KeyError as e:
+            return f"Error: Key '{e.args[0]}' does not exist."
+        except IndexError:
+            return "Error: Insufficient arguments."
+
+    return inner
+
+
+class Command:
+    # The argument schema is parsed once at registration. Plain names are
+    # required, "[name]" is an optional trailing argument, "*name" takes one
+    # or more words joined by spaces ("[*name]" zero or more), and a ":int"
+    # suffix converts the value.
+    def __init__(self, name, handler, schema='', aliases=(), help='', writes=False):
+        self.name = name
+        self.handler = handler
+        self.aliases = aliases
+        self.help = help
+        # Commands that change data; the server runs them exclusively
+        self.writes = writes
+        self.usage = f"{name} {schema.replace(':int', '')}".strip()
+        self.before = []
+        self.rest = None
+        self.rest_optional = False
+        self.after = []
+        self.optional = []
+        for param in schema.split():
+            optional = param.startswith('[')
+            param = param.strip('[]')
+            greedy = param.startswith('*')
+            convert = int if param.endswith(':int') else str
+            if greedy:
+                self.rest = convert
+                self.rest_optional = optional
+            elif optional:
+                self.optional.append(convert)
+            elif self.rest is None:
+                self.before.append(convert)
+            else:
+                self.after.append(convert)
+
+    def parse(self, args):
+        fixed = len(self.before) + len(self.after)
+        if self.rest is not None:
+            if len(args) < fixed + (0 if self.rest_optional else 1):
+                return None
+            split = len(args) - len(self.after)
+            values = args[:len(self.before)] + [' '.join(args[len(self.before):split])] + args[split:]
+            converters = self.before + [self.rest] + self.after
+        else:
+            if not fixed <= len(args) <= fixed + len(self.optional):
+                return None
+            values = args
+            converters = self.before + self.optional
+        try:
+            return [convert(value) for convert, value in zip(converters, values)]
+        except ValueError:
+            return None
+
+    def __call__(self, target, args):
+        values = self.parse(args)
+        if values is None:
+            return f"Usage: {self.usage}"
+        return self.handler(target, *values)
+
+
+class CommandRegistry:
+    # Maps every command name and alias to its Command, so dispatch is a
+    # single dict lookup followed by schema-driven argument parsing.
+    def __init__(self):
+        self.commands = {}
+        # Called with the target after every command that writes, e.g. to
+        # close an undo step
+        self.after_write = None
+
+    def command(self, name, *aliases, args='', help='', writes=False):
+        def register(func):
+            entry = Command(name, input_error(func), args, aliases, help, writes)
+            for key in (name, *aliases):
+                self.commands[key] = entry
+            return func
+
+        return register
+
+    def dispatch(self, target, user_input):
+        parts = user_input.split()
+        if not parts:
+            return "Invalid command."
+        entry = self.commands.get(parts[0].lower())
+        if entry is None:
+            return self.suggest(parts[0].lower())
+        result = entry(target, parts[1:])
+        if entry.writes and self.after_write is not None:
+            self.after_write(target)
+        return result
+
+    def suggest(self, name):
+        names = sorted(self.commands)
+        matches = [candidate for candidate in names if candidate.startswith(name)]
+        matches = matches or difflib.get_close_matches(name, names, n=3)
+        if matches:
+            return f"Invalid command. Did you mean: {', '.join(matches)}?"
+        return "Invalid command."
+
+    def help(self):
+        entries = dict.fromkeys(self.commands.values())
+        return "\n".join(f"{entry.usage} - {entry.help}" for entry in entries)
+
+
+def parse_options(words, allowed):
+    # "--name value" pairs into a dict, e.g. for "all --limit 10 --sort name"
+    options = {}
+    words = iter(words)
+    for word in words:
+        name = word[2:] if word.startswith('--') else None
+        if name not in allowed:
+            raise ValueError(f"Unknown option '{word}'. Use: {', '.join('--' + option for option in allowed)}")
+        value = next(words, None)
+        if value is None:
+            raise ValueError(f"Option '{word}' needs a value")
+        options[name] = value
+    return options
+
+
+def write_result(result, out):
+    # Handlers return a string, or an iterable of lines to stream as they
+    # are produced
+    if isinstance(result, str):
+        out.write(f"{result}\n")
+    else:
+        for line in result:
+            out.write(f"{line}\n")
@@ -0,0 +1,221 @@
+import csv
+from functools import partial
+from itertools import islice
+
+from archive import ArchiveWriter, default_compression, read_archive
+from storage import CONTACT, decode_state
+
+# Contacts travel through this module as state tuples in Record.to_state()
+# layout: (name, phones, emails, addresses, birthday). Everything is a
+# generator, so a file of any size is held in memory one batch at a time.
+
+CSV_FIELDS = ['name', 'phones', 'emails', 'addresses', 'birthday']
+BATCH_SIZE = 1000
+
+
+def read_csv(path):
+    # Yields (line number, state); multi-valued columns are ';'-separated
+    with open(path, newline='', encoding='utf-8') as file:
+        reader = csv.DictReader(file)
+        for row in reader:
+            def values(column):
+                return [value.strip() for value in (row.get(column) or '').split(';') if value.strip()]
+
+            yield reader.line_num, (
+                (row.get('name') or '').strip(),
+                values('phones'),
+                values('emails'),
+                values('addresses'),
+                (row.get('birthday') or '').strip() or None,
+            )
+
+
+def write_csv(path, states):
+    count = 0
+    with open(path, 'w', newline='', encoding='utf-8') as file:
+        writer = csv.writer(file)
+        writer.writerow(CSV_FIELDS)
+        for name, phones, emails, addresses, birthday in states:
+            writer.writerow([name, ';'.join(phones), ';'.join(emails), ';'.join(addresses), birthday or ''])
+            count += 1
+    return count
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace(',', '\\,').replace(';', '\\;')
+
+
+def _unescape(value):
+    result = []
+    chars = iter(value)
+    for char in chars:
+        if char == '\\':
+            char = next(chars, '')
+            result.append('\n' if char in 'nN' else char)
+        else:
+            result.append(char)
+    return ''.join(result)
+
+
+def _split_unescaped(value, separator):
+    parts, current, escaped = [], [], False
+    for char in value:
+        if escaped:
+            current.append('\\' + char)
+            escaped = False
+        elif char == '\\':
+            escaped = True
+        elif char == separator:
+            parts.append(''.join(current))
+            current = []
+        else:
+            current.append(char)
+    parts.append(''.join(current))
+    return [_unescape(part) for part in parts]
+
+
+def _unfolded_lines(file):
+    # vCard folds long lines by starting the continuation with a space
+    pending = None
+    for number, line in enumerate(file, 1):
+        line = line.rstrip('\r\n')
+        if line[:1] in (' ', '\t') and pending is not None:
+            pending = (pending[0], pending[1] + line[1:])
+            continue
+        if pending is not None:
+            yield pending
+        pending = (number, line)
+    if pending is not None:
+        yield pending
+
+
+def read_vcard(path):
+    # Yields (line number of BEGIN:VCARD, state) for FN, TEL, EMAIL, ADR and BDAY
+    with open(path, encoding='utf-8') as file:
+        card = None
+        for number, line in _unfolded_lines(file):
+            key, _, value = line.partition(':')
+            prop = key.split(';')[0].upper()
+            if prop == 'BEGIN':
+                card = {'line': number, 'FN': '', 'TEL': [], 'EMAIL': [], 'ADR': [], 'BDAY': None}
+            elif card is None:
+                continue
+            elif prop == 'END':
+                birthday = card['BDAY']
+                if birthday and len(birthday) == 10 and birthday[4] == '-':
+                    year, month, day = birthday.split('-')
+                    birthday = f"{day}.{month}.{year}"
+                yield card['line'], (card['FN'], card['TEL'], card['EMAIL'], card['ADR'], birthday)
+                card = None
+            elif prop == 'FN':
+                card['FN'] = _unescape(value).strip()
+            elif prop in ('TEL', 'EMAIL'):
+                card[prop].append(_unescape(value).strip())
+            elif prop == 'ADR':
+                parts = [part.strip() for part in _split_unescaped(value, ';')]
+                card['ADR'].append(', '.join(part for part in parts if part))
+            elif prop == 'BDAY':
+                card['BDAY'] = value.strip()
+
+
+def write_vcard(path, states):
+    count = 0
+    with open(path, 'w', encoding='utf-8', newline='') as file:
+        for name, phones, emails, addresses, birthday in states:
+            lines = ['BEGIN:VCARD', 'VERSION:3.0', f"FN:{_escape(name)}", f"N:{_escape(name)};;;;"]
+            lines.extend(f"TEL;TYPE=CELL:{phone}" for phone in phones)
+            lines.extend(f"EMAIL:{_escape(email)}" for email in emails)
+            lines.extend(f"ADR:;;{_escape(address)};;;;" for address in addresses)
+            if birthday and len(birthday) == 10 and birthday[2] == '.':
+                day, month, year = birthday.split('.')
+                lines.append(f"BDAY:{year}-{month}-{day}")
+            lines.append('END:VCARD')
+            file.write('\r\n'.join(lines) + '\r\n')
+            count += 1
+    return count
+
+
+def read_binary(path):
+    # Yields (record number, state) from an archive written by write_binary
+    for number, (_, payload) in enumerate(read_archive(path), 1):
+        yield number, decode_state(payload)
+
+
+def write_binary(path, states):
+    with ArchiveWriter(path, default_compression()) as archive:
+        for state in states:
+            archive.write(state[0], CONTACT.encode(state))
+    return archive.count
+
+
+READERS = {'csv': read_csv, 'vcard': read_vcard, 'binary': read_binary}
+WRITERS = {'csv': write_csv, 'vcard': write_vcard, 'binary': write_binary}
+
+
+def batches(rows, size=BATCH_SIZE):
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+
+def validate_batch(normalize, batch):
+    # normalize(state) returns a validated value (e.g. a Record) or raises
+    # ValueError. Returns ([(line, value)], [(line, state, error)]).
+    valid, rejected = [], []
+    for line, state in batch:
+        if not state[0]:
+            rejected.append((line, state, "Missing name"))
+            continue
+        try:
+            valid.append((line, normalize(state)))
+        except (ValueError, TypeError) as e:
+            rejected.append((line, state, str(e) or type(e).__name__))
+    return valid, rejected
+
+
+def _bounded_map(executor, function, items, window):
+    # Like executor.map, but keeps at most `window` items in flight so a
+    # multi-GB input is never read ahead into memory.
+    pending = []
+    for item in items:
+        pending.append(executor.submit(function, item))
+        if len(pending) >= window:
+            yield pending.pop(0).result()
+    for future in pending:
+        yield future.result()
+
+
+def validated_batches(rows, normalize, workers=0):
+    if workers <= 1:
+        for batch in batches(rows):
+            yield validate_batch(normalize, batch)
+        return
+    from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        yield from _bounded_map(executor, partial(validate_batch, normalize), batches(rows), workers * 2)
+
+
+class RejectWriter:
+    # Opened on the first reject only, so clean imports leave no file behind
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.writer = None
+        self.count = 0
+
+    def write(self, line, state, error):
+        if self.file is None:
+            self.file = open(self.path, 'w', newline='', encoding='utf-8')
+            self.writer = csv.writer(self.file)
+            self.writer.writerow(['line', 'error'] + CSV_FIELDS)
+        name, phones, emails, addresses, birthday = state
+        self.writer.writerow([line, error, name, ';'.join(phones), ';'.join(emails), ';'.join(addresses), birthday or ''])
+        self.count += 1
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
@@ -0,0 +1,300 @@
+# Undo/redo and named snapshots over keyed collections (contacts, notes).
+#
+# A version maps every key changed this session to its state in that
+# version, or ABSENT. Untouched keys are not stored at all: their state is
+# whatever the collection holds, which no version disagrees with. The maps
+# are persistent hash tries (PMap), so each command's version shares all
+# but O(log n) nodes with the previous one, and moving between two
+# versions only visits the subtrees in which they differ. Within one
+# command the working map is edited in place where it owns the nodes (a
+# "transient"), so a bulk import does not copy a path per contact.
+
+BITS = 5
+MASK = (1 << BITS) - 1
+HASH_BITS = 64
+
+
+class _Absent:
+    def __repr__(self):
+        return 'ABSENT'
+
+
+ABSENT = _Absent()
+_UNCHANGED = object()
+
+
+def absent():
+    return ABSENT
+
+
+class _Node:
+    # A bitmap of the occupied slots and a list with one item per set bit: a
+    # (hash, key, value) leaf tuple, a _Node or a _Collision. A node made
+    # during edit `edit` may be changed in place until that edit ends.
+    __slots__ = ('bitmap', 'items', 'edit')
+
+    def __init__(self, bitmap, items, edit=None):
+        self.bitmap = bitmap
+        self.items = items
+        self.edit = edit
+
+
+class _Collision:
+    # Keys whose whole hashes are equal, as (key, value) pairs
+    __slots__ = ('hash', 'pairs')
+
+    def __init__(self, hash, pairs):
+        self.hash = hash
+        self.pairs = pairs
+
+
+def _hash(key):
+    return hash(key) & ((1 << HASH_BITS) - 1)
+
+
+def _pair(a, b, shift, edit):
+    # A subtree holding two leaves
+    if shift >= HASH_BITS:
+        return _Collision(a[0], ((a[1], a[2]), (b[1], b[2])))
+    slot_a, slot_b = (a[0] >> shift) & MASK, (b[0] >> shift) & MASK
+    if slot_a == slot_b:
+        return _Node(1 << slot_a, [_pair(a, b, shift + BITS, edit)], edit)
+    return _Node((1 << slot_a) | (1 << slot_b), [a, b] if slot_a < slot_b else [b, a], edit)
+
+
+def _set(node, leaf, shift, edit):
+    # Returns (node with leaf set, whether the key is new). Nodes of other
+    # edits are copied along the path and left untouched.
+    if type(node) is _Collision:
+        pairs = tuple(pair for pair in node.pairs if pair[0] != leaf[1])
+        return _Collision(node.hash, pairs + ((leaf[1], leaf[2]),)), len(pairs) == len(node.pairs)
+    bit = 1 << ((leaf[0] >> shift) & MASK)
+    index = (node.bitmap & (bit - 1)).bit_count()
+    owned = edit is not None and node.edit is edit
+    if not node.bitmap & bit:
+        if owned:
+            node.items.insert(index, leaf)
+            node.bitmap |= bit
+            return node, True
+        items = node.items[:]
+        items.insert(index, leaf)
+        return _Node(node.bitmap | bit, items, edit), True
+    item = node.items[index]
+    if type(item) is tuple:
+        if item[0] == leaf[0] and item[1] == leaf[1]:
+            child, added = leaf, False
+        else:
+            child, added = _pair(item, leaf, shift + BITS, edit), True
+    else:
+        child, added = _set(item, leaf, shift + BITS, edit)
+    if owned:
+        node.items[index] = child
+        return node, added
+    items = node.items[:]
+    items[index] = child
+    return _Node(node.bitmap, items, edit), added
+
+
+def _items(item):
+    # (key, value) pairs of a leaf or subtree
+    if type(item) is tuple:
+        yield item[1], item[2]
+    elif type(item) is _Collision:
+        yield from item.pairs
+    else:
+        for child in item.items:
+            yield from _items(child)
+
+
+def _same(a, b):
+    return a is b or a == b
+
+
+def _diff(a, b):
+    # Keys whose values differ between two items at the same trie position;
+    # shared subtrees are skipped without being visited
+    if a is b:
+        return
+    if a is None or b is None:
+        yield from (key for key, _ in _items(a if b is None else b))
+        return
+    if type(a) is _Node and type(b) is _Node:
+        # Walk the union of both bitmaps in slot order
+        bitmap = a.bitmap | b.bitmap
+        index_a = index_b = 0
+        while bitmap:
+            bit = bitmap & -bitmap
+            bitmap ^= bit
+            item_a = item_b = None
+            if a.bitmap & bit:
+                item_a = a.items[index_a]
+                index_a += 1
+            if b.bitmap & bit:
+                item_b = b.items[index_b]
+                index_b += 1
+            yield from _diff(item_a, item_b)
+        return
+    # A leaf or collision against anything: compare as small dicts
+    left, right = dict(_items(a)), dict(_items(b))
+    for key, value in left.items():
+        if key not in right or not _same(value, right[key]):
+            yield key
+    for key in right:
+        if key not in left:
+            yield key
+
+
+class PMap:
+    # Persistent hash array mapped trie: set() returns a new map sharing all
+    # nodes off the path to the key
+    __slots__ = ('root', 'count')
+
+    def __init__(self, root=None, count=0):
+        self.root = root if root is not None else _Node(0, [])
+        self.count = count
+
+    def get(self, key, default=None):
+        h = _hash(key)
+        node, shift = self.root, 0
+        while True:
+            if type(node) is _Collision:
+                for other, value in node.pairs:
+                    if other == key:
+                        return value
+                return default
+            bit = 1 << ((h >> shift) & MASK)
+            if not node.bitmap & bit:
+                return default
+            item = node.items[(node.bitmap & (bit - 1)).bit_count()]
+            if type(item) is tuple:
+                return item[2] if item[0] == h and item[1] == key else default
+            node, shift = item, shift + BITS
+
+    def set(self, key, value, edit=None):
+        # `edit` is any object owned by the caller: until the caller stops
+        # passing it, the new map's nodes are reused by later set()s with the
+        # same edit, so only maps from other edits stay unchanged
+        root, added = _set(self.root, (_hash(key), key, value), 0, edit)
+        return PMap(root, self.count + added)
+
+    def __len__(self):
+        return self.count
+
+    def items(self):
+        return _items(self.root)
+
+    def diff(self, other):
+        # Keys with different values in self and other (missing counts as
+        # different)
+        return _diff(self.root, other.root)
+
+
+EMPTY = PMap()
+
+
+class Tracked:
+    # One collection's side of a History: the collection calls touch()
+    # before changing a key and record() after
+    __slots__ = ('history', 'name', 'origins')
+
+    def __init__(self, history, name):
+        self.history = history
+        self.name = name
+        # The state of every changed key before its first change, which is
+        # its state in all versions that do not mention it
+        self.origins = {}
+
+    def touch(self, key, before):
+        # before() returns the key's current state, or ABSENT
+        if not self.history.paused and key not in self.origins:
+            self.origins[key] = self.history.pack(before())
+
+    def record(self, key, state, encoded=None):
+        # encoded: the history's encode(state), when the caller has it
+        history = self.history
+        if not history.paused:
+            value = history.pack(state) if encoded is None else encoded
+            history.working[self.name] = history.working[self.name].set(key, value, history.edit)
+
+
+class History:
+    def __init__(self, names, encode, decode, depth=100):
+        # States are kept as encode(state): bytes, unlike tuples of lists,
+        # are not traversed by every garbage collection, which otherwise
+        # triples the cost of a bulk import
+        self.encode = encode
+        self.decode = decode
+        self.parts = {name: Tracked(self, name) for name in names}
+        self.working = {name: EMPTY for name in names}
+        self.head = dict(self.working)
+        self.undo_stack = []
+        self.redo_stack = []
+        self.labels = {}
+        self.depth = depth
+        # The working maps' transient edit; replaced whenever they become
+        # a version, which freezes their nodes
+        self.edit = object()
+        # Set while changes are applied by undo/redo/restore
+        self.paused = False
+
+    def part(self, name):
+        return self.parts[name]
+
+    def pack(self, state):
+        return state if state is ABSENT else self.encode(state)
+
+    def unpack(self, state):
+        return state if state is ABSENT else self.decode(state)
+
+    def commit(self):
+        # Ends a command: the changes since the last commit become one version
+        if all(self.working[name] is self.head[name] for name in self.working):
+            return
+        self.undo_stack.append(self.head)
+        del self.undo_stack[:-self.depth]
+        self.head = dict(self.working)
+        self.edit = object()
+        self.redo_stack.clear()
+
+    def undo(self):
+        # (part, key, state) changes to apply, or None if there is nothing to undo
+        self.commit()
+        if not self.undo_stack:
+            return None
+        self.redo_stack.append(self.head)
+        return self._move(self.undo_stack.pop())
+
+    def redo(self):
+        self.commit()
+        if not self.redo_stack:
+            return None
+        self.undo_stack.append(self.head)
+        return self._move(self.redo_stack.pop())
+
+    def snapshot(self, label):
+        self.commit()
+        self.labels[label] = self.head
+
+    def restore(self, label):
+        # Like undo, to a labelled version; the restore itself can be undone
+        self.commit()
+        target = self.labels[label]
+        if target is self.head:
+            return []
+        self.undo_stack.append(self.head)
+        self.redo_stack.clear()
+        return self._move(target)
+
+    def _move(self, target):
+        changes = []
+        for name, version in target.items():
+            origins = self.parts[name].origins
+            for key in self.head[name].diff(version):
+                # A version that does not mention a key has it as it was
+                # before its first change
+                state = version.get(key, _UNCHANGED)
+                changes.append((name, key, self.unpack(origins[key] if state is _UNCHANGED else state)))
+        self.head = dict(target)
+        self.working = dict(target)
+        self.edit = object()
+        return changes
@@ -0,0 +1,232 @@
+import io
+import threading
+import time
+from collections import deque
+from functools import wraps
+
+# Opt-in instrumentation. Nothing here runs until enable(): it swaps timing
+# wrappers in for the registry's dispatch, every command handler and the
+# watched methods, and disable() puts the originals back, so a disabled
+# assistant executes exactly the code it would without this module. The
+# profilers are imported by the first capture, not at startup.
+
+BUCKETS = 32  # powers of two of microseconds, the last one is ~36 minutes
+TOP = 15
+
+
+class Histogram:
+    # Latencies in power-of-two microsecond buckets: constant memory and a
+    # cheap record(), with percentiles accurate to a factor of two
+    __slots__ = ('counts', 'count', 'total', 'max')
+
+    def __init__(self):
+        self.counts = [0] * BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        self.counts[min(BUCKETS - 1, int(seconds * 1e6).bit_length())] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, fraction):
+        # Upper bound of the bucket holding the percentile, capped at the max
+        rank = fraction * self.count
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return min(self.max, (1 << bucket) / 1e6)
+        return self.max
+
+
+class Instruments:
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.slow_threshold = 0.1
+        self.slow_log = deque(maxlen=100)
+        self.slow_path = None
+        self.registry = None
+        self.watched = []
+        self.patched = []
+        # Pending captures: (kind, commands left) and their last results
+        self.capture = None
+        self.profiler = None
+        self.profile_report = None
+        self.memory_report = None
+
+    def watch(self, owner, *names):
+        # Methods of `owner` to time while enabled, e.g. load and save paths
+        self.watched.extend((owner, name) for name in names)
+
+    def enable(self, registry):
+        if self.enabled:
+            return
+        self.enabled = True
+        self.registry = registry
+        self._patch(registry, 'dispatch', self._dispatch(registry.dispatch))
+        for entry in dict.fromkeys(registry.commands.values()):
+            self._patch(entry, 'handler', self._timed(f"handler {entry.name}", entry.handler))
+        for owner, name in self.watched:
+            method = owner.__dict__[name]
+            label = f"{owner.__name__}.{name}"
+            if isinstance(method, classmethod):
+                self._patch(owner, name, classmethod(self._timed(label, method.__func__)))
+            else:
+                self._patch(owner, name, self._timed(label, method))
+
+    def disable(self):
+        for target, name, original in reversed(self.patched):
+            if original is None:
+                delattr(target, name)
+            else:
+                setattr(target, name, original)
+        self.patched = []
+        self.enabled = False
+        self._stop_capture()
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {}
+            self.slow_log.clear()
+
+    def _patch(self, target, name, replacement):
+        # Instance attributes shadow the class's; remember whether there was
+        # one so disable() can delete rather than overwrite
+        original = vars(target).get(name)
+        self.patched.append((target, name, original))
+        setattr(target, name, replacement)
+
+    def record(self, label, seconds):
+        with self.lock:
+            histogram = self.histograms.get(label)
+            if histogram is None:
+                histogram = self.histograms[label] = Histogram()
+            histogram.record(seconds)
+
+    def _timed(self, label, function):
+        @wraps(function)
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.record(label, time.perf_counter() - started)
+
+        return timed
+
+    def _dispatch(self, dispatch):
+        # Commands that stream their output are timed until the last line
+        @wraps(dispatch)
+        def timed(target, user_input):
+            parts = user_input.split(maxsplit=1)
+            label = f"command {parts[0].lower() if parts else ''}"
+            # Only commands that start during a capture count towards it, not
+            # the one that starts it
+            capture = self.capture
+            if capture is not None and capture[0] == 'profile':
+                self.profiler.enable()
+            started = time.perf_counter()
+            result = dispatch(target, user_input)
+            if isinstance(result, str):
+                self._finish(label, user_input, started, capture)
+                return result
+            return self._stream(result, label, user_input, started, capture)
+
+        return timed
+
+    def _stream(self, lines, label, user_input, started, capture):
+        try:
+            yield from lines
+        finally:
+            self._finish(label, user_input, started, capture)
+
+    def _finish(self, label, user_input, started, capture):
+        seconds = time.perf_counter() - started
+        self.record(label, seconds)
+        if seconds >= self.slow_threshold:
+            entry = (time.strftime('%Y-%m-%d %H:%M:%S'), seconds, user_input)
+            self.slow_log.append(entry)
+            if self.slow_path is not None:
+                with open(self.slow_path, 'a', encoding='utf-8') as file:
+                    file.write(f"{entry[0]} {seconds * 1e3:.1f} ms {user_input}\n")
+        if capture is not None and capture is self.capture:
+            self._count_capture()
+
+    def start_capture(self, kind, commands):
+        # Profile (cProfile) or trace allocations (tracemalloc) for the next
+        # `commands` commands; the report is kept for stats perf
+        self._stop_capture()
+        if kind == 'profile':
+            import cProfile
+
+            self.profiler = cProfile.Profile()
+        else:
+            import tracemalloc
+
+            tracemalloc.start()
+        self.capture = [kind, commands]
+
+    def _count_capture(self):
+        kind, left = self.capture
+        if kind == 'profile':
+            self.profiler.disable()
+        self.capture[1] = left - 1
+        if left <= 1:
+            self._stop_capture()
+
+    def _stop_capture(self):
+        if self.capture is None:
+            return
+        kind, left = self.capture
+        self.capture = None
+        if kind == 'profile':
+            import pstats
+
+            self.profiler.disable()
+            out = io.StringIO()
+            pstats.Stats(self.profiler, stream=out).sort_stats('cumulative').print_stats(TOP)
+            self.profile_report = out.getvalue().strip().splitlines()
+            self.profiler = None
+        else:
+            import tracemalloc
+
+            snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            self.memory_report = [f"peak {peak / 1024:,.0f} KiB"] + [
+                str(statistic) for statistic in snapshot.statistics('lineno')[:TOP]
+            ]
+
+    def report(self):
+        with self.lock:
+            histograms = sorted(self.histograms.items(), key=lambda item: -item[1].total)
+        lines = [
+            f"Instrumentation: {'on' if self.enabled else 'off'}, slow commands: >= {self.slow_threshold * 1e3:g} ms",
+            f"{'name':<36}{'count':>8}{'total s':>10}{'mean ms':>10}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}",
+        ]
+        for label, histogram in histograms:
+            lines.append(
+                f"{label:<36}{histogram.count:>8}{histogram.total:>10.3f}{histogram.total / histogram.count * 1e3:>10.3f}"
+                f"{histogram.percentile(0.5) * 1e3:>10.3f}{histogram.percentile(0.99) * 1e3:>10.3f}{histogram.max * 1e3:>10.3f}"
+            )
+        if self.slow_log:
+            lines.append("Slow commands:")
+            lines.extend(f"  {when} {seconds * 1e3:.1f} ms {command}" for when, seconds, command in self.slow_log)
+        if self.capture is not None:
+            lines.append(f"Capturing: {self.capture[0]}, {self.capture[1]} commands left")
+        if self.profile_report:
+            lines.append("Last profile:")
+            lines.extend(self.profile_report)
+        if self.memory_report:
+            lines.append("Last memory trace:")
+            lines.extend(self.memory_report)
+        return lines
+
+
+PERF = Instruments()
@@ -0,0 +1,129 @@
+import os
+from functools import partial
+from itertools import islice
+
+from storage import IndexedFile, ShardedMapping, decode_state
+
+# Whole-collection scans split across worker processes. A scan function
+# takes (key, state, *args) and yields its results; it must be a module-level
+# function so it can be sent to a worker.
+#
+# Contacts are never copied to the workers: each one maps the snapshot file
+# itself and scans its share of the index, while the parent covers the
+# records changed since the snapshot was written. In-memory collections
+# (notes) are pickled to the workers in chunks. Below PARALLEL_THRESHOLD
+# items, or with a single CPU, scans simply run in-process.
+
+PARALLEL_THRESHOLD = 100_000
+SHARDS_PER_WORKER = 4
+CHUNK_SIZE = 10_000
+
+_executor = None
+
+
+def worker_count():
+    return os.cpu_count() or 1
+
+
+def executor():
+    # One pool for the whole process, started on the first parallel scan
+    global _executor
+    if _executor is None:
+        # Imported here: multiprocessing is a large share of startup time
+        from concurrent.futures import ProcessPoolExecutor
+
+        _executor = ProcessPoolExecutor(max_workers=worker_count())
+    return _executor
+
+
+class SnapshotChanged(Exception):
+    pass
+
+
+def _scan_shard(path, inode, shard, shards, excluded, function, args):
+    store = IndexedFile(path)
+    try:
+        # A compaction may have replaced the file since the parent opened it
+        if store.inode != inode:
+            raise SnapshotChanged(path)
+        start, stop = store.count * shard // shards, store.count * (shard + 1) // shards
+        return [
+            result
+            for key, payload in store.entries(start, stop) if key not in excluded
+            for result in function(key, decode_state(payload), *args)
+        ]
+    finally:
+        store.close()
+
+
+def _scan_chunk(items, function, args):
+    return [result for key, state in items for result in function(key, state, *args)]
+
+
+def scan_mapping(mapping, from_value, function, args=(), workers=None):
+    # Scans a LazyMapping: untouched entries straight from its snapshot file,
+    # cached ones through from_value. A ShardedMapping is scanned one
+    # LazyMapping per shard file, all of them in flight at once.
+    workers = workers or worker_count()
+    sharded = isinstance(mapping, ShardedMapping)
+    if workers <= 1 or len(mapping) < PARALLEL_THRESHOLD or (not sharded and mapping.store.path is None):
+        for key, state in mapping.scan(decode_state, from_value):
+            yield from function(key, state, *args)
+        return
+    pool = executor()
+    if not sharded:
+        parts = _submit(pool, mapping, from_value, function, args, workers * SHARDS_PER_WORKER)
+        yield from _collect(lambda: mapping.scan(decode_state, from_value), function, args, *parts)
+        return
+    # Opening a shard may close another, so each one's overlay is captured
+    # as soon as it is open
+    shares = max(1, workers * SHARDS_PER_WORKER // mapping.count)
+    pending = [
+        (index, _submit(pool, mapping.shard(index).data, from_value, function, args, shares))
+        for index in range(mapping.count)
+    ]
+    for index, parts in pending:
+        yield from _collect(
+            lambda index=index: mapping.scan_shard(index, decode_state, from_value), function, args, *parts,
+        )
+
+
+def _submit(pool, mapping, from_value, function, args, shares):
+    # Starts workers on `shares` slices of the snapshot; the parent covers
+    # the entries changed since it was written
+    store = mapping.store
+    changed = [(key, from_value(mapping.cache[key])) for key in dict.fromkeys((*mapping.dirty, *mapping.added))]
+    excluded = frozenset(mapping.dirty) | mapping.deleted | mapping.added.keys()
+    futures = [
+        pool.submit(_scan_shard, store.path, store.inode, share, shares, excluded, function, args)
+        for share in range(shares)
+    ] if store.path is not None else []
+    return futures, changed, excluded
+
+
+def _collect(rescan, function, args, futures, changed, excluded):
+    # rescan() scans the mapping in-process, if the workers could not
+    try:
+        results = [future.result() for future in futures]
+    except SnapshotChanged:
+        results = [[
+            result
+            for key, state in rescan() if key not in excluded
+            for result in function(key, state, *args)
+        ]]
+    for share in results:
+        yield from share
+    for key, state in changed:
+        yield from function(key, state, *args)
+
+
+def scan_items(items, count, function, args=(), workers=None):
+    # Scans count (key, state) pairs, pickling them to workers in chunks
+    workers = workers or worker_count()
+    if workers <= 1 or count < PARALLEL_THRESHOLD:
+        yield from _scan_chunk(items, function, args)
+        return
+    items = iter(items)
+    chunks = iter(lambda: list(islice(items, CHUNK_SIZE)), [])
+    for results in executor().map(partial(_scan_chunk, function=function, args=args), chunks):
+        yield from results
@@ -0,0 +1,246 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from itertools import islice
+import sys
+
+# A line protocol over TCP or a Unix socket: the client sends one command
+# per line and every response is its result lines followed by an empty
+# line. Commands run on worker threads; reads share the data, writes get it
+# to themselves, and saves from many clients are folded together.
+
+CHUNK_LINES = 256
+# A streamed response is written ahead of the client by up to SEND_BUFFER
+# bytes. Past that it waits for the client while still holding the data
+# lock, so a client that takes nothing for SEND_TIMEOUT seconds is dropped
+# rather than allowed to stall every writer (and, behind them, readers).
+SEND_BUFFER = 1 << 20
+SEND_TIMEOUT = 2.0
+
+
+def parse_address(address):
+    # "host:port" for TCP, anything else is a Unix socket path
+    host, _, port = address.rpartition(':')
+    if port.isdigit() and '/' not in address:
+        return host or '127.0.0.1', int(port)
+    return address, None
+
+
+async def open_connection(address):
+    host, port = parse_address(address)
+    if port is None:
+        return await asyncio.open_unix_connection(host)
+    return await asyncio.open_connection(host, port)
+
+
+async def read_response(reader):
+    lines = []
+    while True:
+        line = await reader.readline()
+        if not line:
+            raise ConnectionError("Server closed the connection")
+        line = line.decode().rstrip('\n')
+        if not line:
+            return lines
+        lines.append(line)
+
+
+class ReadWriteLock:
+    # Any number of readers or one writer. A waiting writer holds back new
+    # readers, so a steady stream of reads cannot starve it.
+    def __init__(self):
+        self.readers = 0
+        self.writer = False
+        self.waiting_writers = 0
+        self.condition = asyncio.Condition()
+
+    @asynccontextmanager
+    async def reading(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: not self.writer and not self.waiting_writers)
+            self.readers += 1
+        try:
+            yield
+        finally:
+            async with self.condition:
+                self.readers -= 1
+                self.condition.notify_all()
+
+    @asynccontextmanager
+    async def writing(self):
+        async with self.condition:
+            self.waiting_writers += 1
+            try:
+                await self.condition.wait_for(lambda: not self.writer and not self.readers)
+            finally:
+                self.waiting_writers -= 1
+            self.writer = True
+        try:
+            yield
+        finally:
+            async with self.condition:
+                self.writer = False
+                self.condition.notify_all()
+
+
+class SaveCoalescer:
+    # Every save request is answered once a save that started after it has
+    # finished. Requests arriving while a save runs are all covered by the
+    # next one, so any number of concurrent "save" commands costs two saves.
+    def __init__(self, save, lock, executor, delay=0.01):
+        self.save = save
+        self.lock = lock
+        self.executor = executor
+        self.delay = delay
+        self.requested = 0
+        self.completed = 0
+        self.error = None
+        self.saves = 0
+        self.task = None
+        self.finished = asyncio.Condition()
+
+    async def request(self):
+        # Returns None, or the error of the save that covered this request
+        self.requested += 1
+        target = self.requested
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+        async with self.finished:
+            await self.finished.wait_for(lambda: self.completed >= target)
+        return self.error
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while self.completed < self.requested:
+            await asyncio.sleep(self.delay)
+            target = self.requested
+            error = None
+            async with self.lock.writing():
+                try:
+                    await loop.run_in_executor(self.executor, self.save)
+                except Exception as e:
+                    error = f"Save failed: {e}"
+            self.saves += 1
+            async with self.finished:
+                self.completed = target
+                self.error = error
+                self.finished.notify_all()
+
+
+class Session:
+    # Per-connection state; "exit" ends the session, not the server
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.peer = writer.get_extra_info('peername') or 'unix socket'
+        self.commands = 0
+        writer.transport.set_write_buffer_limits(high=SEND_BUFFER)
+
+    def send(self, lines):
+        for line in lines:
+            # An empty line ends a response, so blank result lines become a space
+            self.writer.write(f"{line or ' '}\n".encode())
+
+    async def end(self):
+        self.writer.write(b"\n")
+        await self.writer.drain()
+
+    async def drain(self, timeout):
+        try:
+            await asyncio.wait_for(self.writer.drain(), timeout)
+        except asyncio.TimeoutError:
+            self.writer.transport.abort()
+            raise ConnectionError(f"{self.peer} stopped reading its response") from None
+
+
+class Server:
+    def __init__(self, target, registry, save, workers=4):
+        self.target = target
+        self.registry = registry
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.lock = ReadWriteLock()
+        self.saver = None
+        self.save = save
+        self.sessions = set()
+
+    async def run(self, address, ready=None):
+        self.saver = SaveCoalescer(self.save, self.lock, self.executor)
+        host, port = parse_address(address)
+        if port is None:
+            server = await asyncio.start_unix_server(self.handle_client, host)
+        else:
+            server = await asyncio.start_server(self.handle_client, host, port)
+        if ready is not None:
+            ready(server)
+        async with server:
+            try:
+                await server.serve_forever()
+            finally:
+                await self.saver.request()
+                self.executor.shutdown()
+
+    async def handle_client(self, reader, writer):
+        session = Session(reader, writer)
+        self.sessions.add(session)
+        try:
+            session.send(["Welcome to the assistant bot!"])
+            await session.end()
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                command = line.decode().strip()
+                session.commands += 1
+                if not await self.execute(session, command):
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            self.sessions.discard(session)
+            writer.close()
+
+    async def execute(self, session, command):
+        # Returns False once the client said goodbye
+        name = command.split()[0].lower() if command else ''
+        if name in ('save', 'exit', 'close'):
+            error = await self.saver.request()
+            goodbye = name != 'save'
+            session.send([error or ("Good bye!" if goodbye else "Address book and notes saved.")])
+            await session.end()
+            return not goodbye
+        loop = asyncio.get_running_loop()
+        entry = self.registry.commands.get(name)
+        guard = self.lock.writing() if entry is not None and entry.writes else self.lock.reading()
+        async with guard:
+            result = await loop.run_in_executor(self.executor, self.registry.dispatch, self.target, command)
+            if isinstance(result, str):
+                session.send(result.splitlines())
+            else:
+                # Streamed results are drawn on a worker a chunk at a time and
+                # sent as they come, still under the lock they started with
+                result = iter(result)
+                while True:
+                    lines = await loop.run_in_executor(self.executor, _take, result, CHUNK_LINES)
+                    if not lines:
+                        break
+                    session.send(lines)
+                    await session.drain(SEND_TIMEOUT)
+        await session.end()
+        return True
+
+
+def _take(iterator, count):
+    return list(islice(iterator, count))
+
+
+def serve(target, registry, save, address, workers=4):
+    # Commands are short, so hand the GIL between the event loop and the
+    # workers more often than the default 5 ms to keep latency down
+    sys.setswitchinterval(0.0005)
+    server = Server(target, registry, save, workers)
+    try:
+        asyncio.run(server.run(address, lambda _: print(f"Serving on {address}", flush=True)))
+    except KeyboardInterrupt:
+        pass
+    if server.saver is not None:
+        print(f"{server.saver.requested} save requests served by {server.saver.saves} saves")
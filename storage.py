@@ -0,0 +1,963 @@
+import array
+import hashlib
+import mmap
+import os
+import pickle
+import struct
+import threading
+import zlib
+from collections.abc import MutableMapping
+from contextlib import contextmanager
+from itertools import chain
+
+_LENGTH = struct.Struct('<I')
+_HEADER = struct.Struct('<4sHHQQ')  # magic, version, reserved, record count, index offset
+_ENTRY = struct.Struct('<III')  # key length, payload length, crc32 of key and payload
+_SLOT = struct.Struct('<QQ')  # key hash, heap offset
+_RECORD = struct.Struct('<BH')  # schema id, number of integers
+_CHECKSUM = struct.Struct('<I')  # crc32 of a journal entry's header, key and payload
+_JOURNAL_ENTRY = struct.Struct('<BH')  # operation, key length
+
+MAGIC = b'ABIX'
+VERSION = 2
+JOURNAL_MAGIC = b'ABJ2'
+_PUT, _DELETE = 0, 1
+
+# Field kinds of a Schema
+TEXT, OPTIONAL_TEXT, TEXT_LIST, NUMBER = range(4)
+_NONE = 0xFFFFFFFF
+_INTEGERS = {}
+
+
+def _integers(count):
+    layout = _INTEGERS.get(count)
+    if layout is None:
+        layout = _INTEGERS[count] = struct.Struct(f'<{count}I')
+    return layout
+
+
+class Schema:
+    # A record layout. An encoded record is the schema id, the integers that
+    # describe its fields (text lengths in characters, list sizes, numbers),
+    # then all of its text as one UTF-8 string, so a record of any shape is
+    # read with one struct call and one decode. Ids are never reused: a new
+    # layout gets a new id and old files stay readable.
+    def __init__(self, schema_id, name, fields, scalar=False):
+        self.id = schema_id
+        self.name = name
+        self.fields = fields
+        self.scalar = scalar
+
+    def encode(self, state):
+        values = (state,) if self.scalar else state
+        if len(values) != len(self.fields):
+            raise ValueError(f"A {self.name} has {len(self.fields)} fields, got {len(values)}")
+        integers, texts = [], []
+        for kind, value in zip(self.fields, values):
+            if kind == TEXT or (kind == OPTIONAL_TEXT and value is not None):
+                integers.append(len(value))
+                texts.append(value)
+            elif kind == OPTIONAL_TEXT:
+                integers.append(_NONE)
+            elif kind == TEXT_LIST:
+                integers.append(len(value))
+                integers.extend(map(len, value))
+                texts.extend(value)
+            else:
+                integers.append(value)
+        return (
+            _RECORD.pack(self.id, len(integers))
+            + _integers(len(integers)).pack(*integers)
+            + ''.join(texts).encode('utf-8', 'surrogatepass')
+        )
+
+    def decode(self, integers, text):
+        values = []
+        position = index = 0
+        for kind in self.fields:
+            value = integers[index]
+            index += 1
+            if kind == TEXT_LIST:
+                items = []
+                for length in integers[index:index + value]:
+                    items.append(text[position:position + length])
+                    position += length
+                index += value
+            elif kind == NUMBER:
+                items = value
+            elif value == _NONE and kind == OPTIONAL_TEXT:
+                items = None
+            else:
+                items = text[position:position + value]
+                position += value
+            values.append(items)
+        return values[0] if self.scalar else tuple(values)
+
+
+# (name, phones, emails, addresses, birthday) from assistant.py, (name,
+# phones, birthday) from bot.py, (id, content, tags) for notes, and bare
+# numbers such as the notes' next id.
+CONTACT = Schema(1, 'contact', (TEXT, TEXT_LIST, TEXT_LIST, TEXT_LIST, OPTIONAL_TEXT))
+BOT_CONTACT = Schema(2, 'bot contact', (TEXT, TEXT_LIST, OPTIONAL_TEXT))
+NOTE = Schema(3, 'note', (NUMBER, TEXT, TEXT_LIST))
+COUNTER = Schema(4, 'counter', (NUMBER,), scalar=True)
+SCHEMAS = {schema.id: schema for schema in (CONTACT, BOT_CONTACT, NOTE, COUNTER)}
+
+
+def schema_for(state):
+    if isinstance(state, int):
+        return COUNTER
+    if len(state) == 5:
+        return CONTACT
+    if len(state) == 3:
+        return NOTE if isinstance(state[0], int) else BOT_CONTACT
+    raise ValueError(f"No schema for a state with {len(state)} fields")
+
+
+def encode_state(state):
+    return schema_for(state).encode(state)
+
+
+def decode_state(payload):
+    schema_id, count = _RECORD.unpack_from(payload)
+    schema = SCHEMAS.get(schema_id)
+    if schema is None:
+        raise ValueError(f"Unknown record schema {schema_id}")
+    start = _RECORD.size + 4 * count
+    integers = _integers(count).unpack_from(payload, _RECORD.size)
+    return schema.decode(integers, bytes(payload[start:]).decode('utf-8', 'surrogatepass'))
+
+
+def fsync_directory(path):
+    # Makes a rename or removal in path's directory survive a power loss
+    if os.name == 'nt':
+        return
+    descriptor = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(descriptor)
+    finally:
+        os.close(descriptor)
+
+
+def _key_hash(key):
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'little')
+
+
+class LegacyObject:
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+
+class LegacyUnpickler(pickle.Unpickler):
+    # Old address books pickled Record/Name/Phone/... objects from whichever
+    # module happened to be __main__. Map them onto plain attribute bags so
+    # the file no longer depends on the current class layout.
+    def find_class(self, module, name):
+        if module in ('__main__', 'assistant', 'bot'):
+            return LegacyObject
+        if (module, name) in (('copyreg', '_reconstructor'), ('builtins', 'object')):
+            return super().find_class(module, name)
+        raise pickle.UnpicklingError(f"Unexpected class {module}.{name} in address book")
+
+
+def load_legacy(path):
+    with open(path, 'rb') as file:
+        return LegacyUnpickler(file).load()
+
+
+def legacy_state(value):
+    # A record from an old pickle file: either already a state tuple or the
+    # attributes of a pickled Record.
+    if isinstance(value, tuple):
+        return value
+    fields = value.__dict__
+
+    def values(items):
+        return [getattr(item, 'value', item) for item in items]
+
+    birthday = fields.get('birthday')
+    return (
+        fields['name'].value,
+        values(fields.get('phones', [])),
+        values(fields.get('emails', [])),
+        values(fields.get('addresses', [])),
+        getattr(birthday, 'value', birthday),
+    )
+
+
+class IndexedFile:
+    # Read-only snapshot: a header, a heap of (key, payload) entries and a
+    # fixed-layout index of (key hash, heap offset) slots sorted by hash. The
+    # file is mmapped, so opening it costs nothing and a lookup only touches
+    # the index pages on its binary search path plus one heap entry.
+    def __init__(self, path=None):
+        self.path = path
+        self.map = None
+        self.inode = None
+        self.count = 0
+        self.index_offset = _HEADER.size
+        if path is None or not os.path.exists(path) or os.path.getsize(path) == 0:
+            return
+        with open(path, 'rb') as file:
+            # Identifies this version of the file once a compaction replaces it
+            self.inode = os.fstat(file.fileno()).st_ino
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, _, self.count, self.index_offset = _HEADER.unpack_from(self.map)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise ValueError(f"{path} is not a version {VERSION} address book file")
+
+    @staticmethod
+    def is_indexed(path):
+        try:
+            with open(path, 'rb') as file:
+                return file.read(len(MAGIC)) in (MAGIC, b'')
+        except FileNotFoundError:
+            return True
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def _entry(self, offset):
+        # (key, payload) at a heap offset, checked against its crc32
+        key_length, payload_length, checksum = _ENTRY.unpack_from(self.map, offset)
+        start = offset + _ENTRY.size
+        end = start + key_length + payload_length
+        if zlib.crc32(self.map[start:end]) != checksum:
+            raise ValueError(f"{self.path} is corrupted at offset {offset}")
+        return self.map[start:start + key_length], self.map[start + key_length:end], end
+
+    def get(self, key):
+        if not self.count:
+            return None
+        key = key.encode()
+        target = _key_hash(key)
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if _SLOT.unpack_from(self.map, self.index_offset + middle * _SLOT.size)[0] < target:
+                low = middle + 1
+            else:
+                high = middle
+        while low < self.count:
+            slot_hash, offset = _SLOT.unpack_from(self.map, self.index_offset + low * _SLOT.size)
+            if slot_hash != target:
+                break
+            entry_key, payload, _ = self._entry(offset)
+            if entry_key == key:
+                return payload
+            low += 1
+        return None
+
+    def items(self):
+        offset = _HEADER.size
+        while offset < self.index_offset:
+            key, payload, offset = self._entry(offset)
+            yield key.decode(), payload
+
+    def entries(self, start, stop):
+        # (key, payload) for index slots start..stop-1, i.e. a share of the
+        # file that a worker can scan independently
+        for slot in range(start, stop):
+            _, offset = _SLOT.unpack_from(self.map, self.index_offset + slot * _SLOT.size)
+            key, payload, _ = self._entry(offset)
+            yield key.decode(), payload
+
+    def keys(self):
+        for key, _ in self.items():
+            yield key
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+    @staticmethod
+    def write(path, items):
+        slots = []
+        temp = path + '.tmp'
+        with open(temp, 'wb') as file:
+            file.write(_HEADER.pack(MAGIC, VERSION, 0, 0, 0))
+            offset = _HEADER.size
+            for key, payload in items:
+                key = key.encode()
+                # Hash in the high bits so a plain int sort orders slots by hash
+                slots.append(_key_hash(key) << 64 | offset)
+                file.write(_ENTRY.pack(len(key), len(payload), zlib.crc32(payload, zlib.crc32(key))))
+                file.write(key)
+                file.write(payload)
+                offset += _ENTRY.size + len(key) + len(payload)
+            slots.sort()
+            mask = (1 << 64) - 1
+            for slot in slots:
+                file.write(_SLOT.pack(slot >> 64, slot & mask))
+            file.seek(0)
+            file.write(_HEADER.pack(MAGIC, VERSION, 0, len(slots), offset))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp, path)
+        fsync_directory(path)
+
+
+class LazyMapping(MutableMapping):
+    # Dict-like view over an IndexedFile. Values are only decoded when looked
+    # up; writes and deletes live in an in-memory overlay until the next
+    # snapshot is written.
+    def __init__(self, decode, encode, store=None):
+        self.decode = decode
+        self.encode = encode
+        self.store = store or IndexedFile()
+        self.cache = {}
+        self.dirty = set()
+        self.deleted = set()
+        self.added = {}
+        # Keys changed since snapshot_items() was last called, for rebase()
+        self.since = None
+
+    def __getitem__(self, key):
+        if key in self.cache:
+            return self.cache[key]
+        if key in self.deleted:
+            raise KeyError(key)
+        payload = self.store.get(key)
+        if payload is None:
+            raise KeyError(key)
+        value = self.cache[key] = self.decode(payload)
+        return value
+
+    def __setitem__(self, key, value):
+        if key not in self.cache and key not in self.added and key not in self.store:
+            self.added[key] = None
+        self.deleted.discard(key)
+        self.cache[key] = value
+        self.dirty.add(key)
+        if self.since is not None:
+            self.since.add(key)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self.cache.pop(key, None)
+        self.dirty.discard(key)
+        if key in self.added:
+            del self.added[key]
+        else:
+            self.deleted.add(key)
+        if self.since is not None:
+            self.since.add(key)
+
+    def __contains__(self, key):
+        if key in self.cache or key in self.added:
+            return True
+        return key not in self.deleted and key in self.store
+
+    def __iter__(self):
+        for key in self.store.keys():
+            if key not in self.deleted:
+                yield key
+        yield from list(self.added)
+
+    def __len__(self):
+        return len(self.store) - len(self.deleted) + len(self.added)
+
+    def scan(self, from_payload, from_value):
+        # Iterate (key, value) without filling the cache: untouched entries
+        # are converted straight from their payload, loaded ones from the
+        # in-memory object.
+        for key, payload in self.store.items():
+            if key in self.deleted:
+                continue
+            if key in self.cache:
+                yield key, from_value(self.cache[key])
+            else:
+                yield key, from_payload(payload)
+        for key in list(self.added):
+            yield key, from_value(self.cache[key])
+
+    def peek(self, key, from_payload, from_value):
+        # Like scan, for a single key
+        if key in self.cache:
+            return from_value(self.cache[key])
+        if key in self.deleted:
+            raise KeyError(key)
+        payload = self.store.get(key)
+        if payload is None:
+            raise KeyError(key)
+        return from_payload(payload)
+
+    def mark_dirty(self, key):
+        self.dirty.add(key)
+        if self.since is not None:
+            self.since.add(key)
+
+    def snapshot_items(self):
+        # Capture the overlay now so the returned generator can be drained on
+        # another thread while the mapping keeps changing. Only references
+        # are copied; changed values are encoded as the generator runs, so a
+        # value changed later may be written in its newer state. That is
+        # harmless: the change is also in the journal that follows the
+        # snapshot, and replaying a put is idempotent.
+        changed = {key: self.cache[key] for key in self.dirty}
+        deleted = set(self.deleted)
+        added = list(self.added)
+        store = self.store
+        encode = self.encode
+        self.since = set()
+
+        def items():
+            for key, payload in store.items():
+                if key not in deleted:
+                    yield key, encode(changed[key]) if key in changed else payload
+            for key in added:
+                yield key, encode(changed[key])
+
+        return items()
+
+    def rebase(self, store):
+        # Switch to `store`, a snapshot written from the last snapshot_items(),
+        # so scans read the file that is on disk now. Keys changed since the
+        # capture stay in the overlay, relative to the new file; everything
+        # else is in it. Nothing may still be reading the old store.
+        since = self.since or ()
+        present = [key for key in since if key in self.cache]
+        self.dirty = set(present)
+        self.added = dict.fromkeys(key for key in chain(self.added, present) if key in self.cache and key not in store)
+        self.deleted = {key for key in since if key not in self.cache and key in store}
+        self.since = None
+        self.store.close()
+        self.store = store
+
+    def close(self):
+        self.store.close()
+
+
+class JournaledFile:
+    # A snapshot file plus an append-only journal of ('put', key, state) and
+    # ('delete', key, None) entries. Saving only syncs the journal; once the
+    # journal grows past compact_threshold it is folded into a fresh snapshot.
+    # Both happen on a writer thread, so save() returns at once and the
+    # files on disk are always either the previous or the new valid state.
+    #
+    # Each entry is handed to the OS as it is appended so a crash of the
+    # process loses nothing; bulk loads can turn autoflush off and rely on
+    # sync() instead.
+    autoflush = True
+
+    def __init__(self, filename, compact_threshold=1 << 20):
+        self.filename = filename
+        self.journal_path = filename + '.journal'
+        self.rotated_path = filename + '.journal.old'
+        self.compact_threshold = compact_threshold
+        self.file = None
+        # Writer thread state: save requests made and done, and a rotated
+        # journal with the snapshot items waiting to be compacted
+        self.lock = threading.Lock()
+        self.condition = threading.Condition()
+        self.requested = 0
+        self.completed = 0
+        self.compaction = None
+        self.writer = None
+        self.closing = False
+        # The last write error, raised by the next save() or close(), and
+        # whether a failed compaction left its rotated journal behind
+        self.error = None
+        self.unfolded = False
+        # Whether a compaction has replaced the snapshot since the last save()
+        self.compacted = False
+
+    def load(self):
+        # Returns the mmapped snapshot, the contents of a legacy pickle file
+        # (migrated on open) and the journal entries recorded since.
+        legacy = {}
+        if IndexedFile.is_indexed(self.filename):
+            store = IndexedFile(self.filename)
+        else:
+            store = IndexedFile()
+            legacy = load_legacy(self.filename)
+        entries = list(self._replay(self.rotated_path))
+        entries.extend(self._replay(self.journal_path))
+        return store, legacy, entries
+
+    def _replay(self, path):
+        # Yields (op, key, state) with op 'put' or 'delete'
+        try:
+            file = open(path, 'rb')
+        except FileNotFoundError:
+            return
+        with file:
+            magic = file.read(len(JOURNAL_MAGIC))
+            if magic != JOURNAL_MAGIC and not JOURNAL_MAGIC.startswith(magic):
+                raise ValueError(f"{path} is not an address book journal")
+            # A journal cut short inside its magic is empty
+            good = file.tell() if magic == JOURNAL_MAGIC else 0
+            while True:
+                header = file.read(_LENGTH.size)
+                if len(header) < _LENGTH.size:
+                    break
+                (length,) = _LENGTH.unpack(header)
+                data = file.read(length)
+                if len(data) < length:
+                    break
+                try:
+                    entry = self._decode_entry(data)
+                except (ValueError, struct.error):
+                    # A damaged entry ends the journal like a torn tail does
+                    break
+                good = file.tell()
+                yield entry
+        # Drop a torn or damaged tail left by a crash mid-append so new
+        # entries stay readable
+        if os.path.getsize(path) != good:
+            os.truncate(path, good)
+
+    @staticmethod
+    def _decode_entry(data):
+        (checksum,) = _CHECKSUM.unpack_from(data)
+        body = memoryview(data)[_CHECKSUM.size:]
+        if zlib.crc32(body) != checksum:
+            raise ValueError("journal entry checksum mismatch")
+        op, key_length = _JOURNAL_ENTRY.unpack_from(body)
+        key = bytes(body[_JOURNAL_ENTRY.size:_JOURNAL_ENTRY.size + key_length]).decode()
+        if op == _PUT:
+            return 'put', key, decode_state(body[_JOURNAL_ENTRY.size + key_length:])
+        if op == _DELETE:
+            return 'delete', key, None
+        raise ValueError(f"unknown journal operation {op}")
+
+    def open(self, items, rewrite=False):
+        # A leftover rotated journal means a compaction was interrupted; fold
+        # everything into a new snapshot before accepting new writes.
+        if rewrite or os.path.exists(self.rotated_path):
+            self._replace_snapshot(items())
+        self.file = self._open_journal()
+
+    def _replace_snapshot(self, items):
+        IndexedFile.write(self.filename, items)
+        for path in (self.journal_path, self.rotated_path):
+            if os.path.exists(path):
+                os.remove(path)
+        fsync_directory(self.filename)
+
+    def checkpoint(self, items):
+        # Close, folding everything into a new snapshot now, so the next load
+        # has no journal to replay
+        self.close()
+        try:
+            self._replace_snapshot(items())
+        except BaseException:
+            # The journal still holds every change; keep appending to it
+            self.file = self._open_journal()
+            raise
+
+    def _open_journal(self):
+        file = open(self.journal_path, 'ab')
+        if file.tell() == 0:
+            file.write(JOURNAL_MAGIC)
+        return file
+
+    def put(self, key, state, payload=None):
+        # payload: encode_state(state), when the caller already has it
+        self._append(_PUT, key, encode_state(state) if payload is None else payload)
+
+    def delete(self, key):
+        self._append(_DELETE, key, b'')
+
+    def _append(self, op, key, payload):
+        # Length, checksum, then the checksummed (op, key length, key, payload)
+        key = key.encode()
+        body = _JOURNAL_ENTRY.pack(op, len(key)) + key + payload
+        self.file.write(_LENGTH.pack(_CHECKSUM.size + len(body)) + _CHECKSUM.pack(zlib.crc32(body)) + body)
+        if self.autoflush:
+            self.file.flush()
+
+    def sync(self):
+        with self.lock:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def needs_compaction(self):
+        return self.file.tell() > self.compact_threshold
+
+    def save(self, snapshot_items, rebase=None):
+        # Queue a sync of the journal, and a compaction from snapshot_items()
+        # when the journal is large, for the writer thread. rebase(store) is
+        # called with the new snapshot once a compaction has written one.
+        with self.condition:
+            if self.compacted:
+                # Done in the same step that may capture the next compaction,
+                # so the mapping moves onto exactly the snapshot of its last
+                # capture, and no compaction still reads the store it drops
+                self.compacted = False
+                if rebase is not None:
+                    rebase(IndexedFile(self.filename))
+            if self.compaction is None and (self.unfolded or self.needs_compaction()):
+                # A rotated journal left by a failed compaction is folded in
+                # first; rotating again would overwrite it
+                self.compaction = None if self.unfolded else self._rotate(), snapshot_items()
+            self.requested += 1
+            if self.writer is None or not self.writer.is_alive():
+                self.writer = threading.Thread(target=self._write, name=f"writer {self.filename}", daemon=True)
+                self.writer.start()
+            self.condition.notify_all()
+            error, self.error = self.error, None
+        if error is not None:
+            raise error
+
+    def _rotate(self):
+        # New entries go to a fresh journal from here on; the rotated one is
+        # replayed on load until the snapshot that includes it is in place
+        with self.lock:
+            rotated = self.file
+            rotated.flush()
+            os.replace(self.journal_path, self.rotated_path)
+            self.file = self._open_journal()
+        return rotated
+
+    def _write(self):
+        while True:
+            with self.condition:
+                while self.completed == self.requested and not self.closing:
+                    self.condition.wait()
+                if self.completed == self.requested:
+                    return
+                requested, compaction = self.requested, self.compaction
+            error = None
+            try:
+                self.sync()
+                if compaction is not None:
+                    self._compact(*compaction)
+            except Exception as e:
+                # E.g. a full disk. The requests still count as done, so
+                # wait() returns; the rotated journal stays on disk, is
+                # replayed on load and is folded in by the next compaction.
+                error = e
+                if compaction is not None and compaction[0] is not None:
+                    compaction[0].close()
+            with self.condition:
+                self.completed = requested
+                if compaction is not None:
+                    self.compaction = None
+                    self.unfolded = error is not None
+                    self.compacted = self.compacted or error is None
+                if error is not None:
+                    self.error = error
+                self.condition.notify_all()
+
+    def _compact(self, rotated, items):
+        if rotated is not None:
+            try:
+                os.fsync(rotated.fileno())
+            finally:
+                rotated.close()
+            fsync_directory(self.filename)
+        IndexedFile.write(self.filename, items)
+        os.remove(self.rotated_path)
+        fsync_directory(self.filename)
+
+    def wait(self):
+        # Block until every save requested so far is on disk
+        with self.condition:
+            while self.completed != self.requested:
+                self.condition.wait()
+
+    def close(self):
+        # The journal is only closed once the final sync succeeds; otherwise
+        # the error is raised and it stays open, so the owner can keep using
+        # it and save or close again. A write error still pending from the
+        # writer is dropped then: every entry is on disk, and a rotated
+        # journal a failed compaction left behind is replayed on load.
+        if self.writer is not None:
+            with self.condition:
+                self.closing = True
+                self.condition.notify_all()
+            self.writer.join()
+            self.writer = None
+            self.closing = False
+        if self.file is not None:
+            self.sync()
+            self.file.close()
+            self.file = None
+        self.error = None
+
+
+# A shard's memory is estimated as its mapped snapshot plus this much per
+# decoded record (see benchmarks/memory.py)
+RESIDENT_RECORD_BYTES = 600
+
+
+class Shard:
+    # One partition of a ShardedMapping: a snapshot with its journal and
+    # overlay, like an unsharded segment
+    def __init__(self, path, decode, encode, restore):
+        self.path = path
+        self.journal = JournaledFile(path)
+        store, _, entries = self.journal.load()
+        self.data = LazyMapping(decode, encode, store)
+        for op, key, state in entries:
+            if op == 'put':
+                self.data[key] = restore(state)
+            elif key in self.data:
+                del self.data[key]
+        self.journal.open(self.data.snapshot_items)
+        self.pins = 0
+        self.changed = False
+
+    def footprint(self):
+        mapped = len(self.data.store.map) if self.data.store.map is not None else 0
+        return mapped + len(self.data.cache) * RESIDENT_RECORD_BYTES
+
+    def close(self):
+        # Written back on its own: a shard with changes gets a new snapshot
+        data = self.data
+        if data.dirty or data.deleted or data.added:
+            self.journal.checkpoint(data.snapshot_items)
+        else:
+            self.journal.close()
+        data.close()
+
+
+class ShardedMapping(MutableMapping):
+    # A LazyMapping split by a stable hash of partition(key) over `count`
+    # shard files, each opened on first use. Opened shards are kept in LRU
+    # order and the least recently used are closed whenever the estimated
+    # memory of the open ones exceeds `budget` bytes. Shards that are being
+    # iterated are pinned and never closed under the iterator.
+    #
+    # It also stands in for the JournaledFile of an unsharded book (put,
+    # delete, save, close), routing each call to the key's shard.
+    def __init__(self, filename, count, budget, decode, encode, restore, partition=str):
+        if not 1 <= count <= 0xFFFF:
+            raise ValueError("The number of shards must be between 1 and 65535")
+        self.filename = filename
+        self.count = count
+        self.budget = budget
+        self.decode = decode
+        self.encode = encode
+        self.restore = restore
+        self.partition = partition
+        self.resident = {}  # index -> Shard, least recently used first
+        self.lengths = [None] * count
+        # Server reads run concurrently; opening and closing shards must not
+        self.lock = threading.RLock()
+
+    def shard_path(self, index):
+        return f"{self.filename}.{index:03d}-of-{self.count:03d}"
+
+    def shard_of(self, key):
+        return zlib.crc32(self.partition(key).encode('utf-8', 'surrogatepass')) % self.count
+
+    def shard(self, index):
+        with self.lock:
+            shard = self.resident.pop(index, None)
+            if shard is None:
+                shard = Shard(self.shard_path(index), self.decode, self.encode, self.restore)
+                self._evict(shard.footprint())
+            self.resident[index] = shard
+            return shard
+
+    def _evict(self, incoming):
+        # Close least recently used, unpinned shards until `incoming` fits
+        used = incoming + sum(shard.footprint() for shard in self.resident.values())
+        for index, shard in list(self.resident.items()):
+            if used <= self.budget:
+                break
+            if shard.pins:
+                continue
+            try:
+                shard.close()
+            except OSError:
+                # E.g. a full disk: the shard stays open with its changes, to
+                # be written back by a later save or close
+                continue
+            used -= shard.footprint()
+            self.lengths[index] = len(shard.data)
+            del self.resident[index]
+
+    @contextmanager
+    def _pin(self, index):
+        # The shard at index, pinned so no other reader can close it while
+        # it is in use. The pin is taken in the same hold of the lock that
+        # fetches the shard, so it cannot be evicted in between either.
+        with self.lock:
+            shard = self.shard(index)
+            shard.pins += 1
+        try:
+            yield shard
+        finally:
+            with self.lock:
+                shard.pins -= 1
+
+    def _pinned(self, index, items):
+        # Yields from items(shard) with the shard pinned until exhausted
+        with self._pin(index) as shard:
+            yield from items(shard)
+
+    def __getitem__(self, key):
+        with self._pin(self.shard_of(key)) as shard:
+            return shard.data[key]
+
+    def __setitem__(self, key, value):
+        with self._pin(self.shard_of(key)) as shard:
+            shard.data[key] = value
+
+    def __delitem__(self, key):
+        with self._pin(self.shard_of(key)) as shard:
+            del shard.data[key]
+
+    def __contains__(self, key):
+        with self._pin(self.shard_of(key)) as shard:
+            return key in shard.data
+
+    def __iter__(self):
+        for index in range(self.count):
+            yield from self._pinned(index, lambda shard: iter(shard.data))
+
+    def __len__(self):
+        total = 0
+        for index in range(self.count):
+            with self.lock:
+                if index in self.resident or self.lengths[index] is None:
+                    self.lengths[index] = len(self.shard(index).data)
+                total += self.lengths[index]
+        return total
+
+    def scan(self, from_payload, from_value):
+        for index in range(self.count):
+            yield from self.scan_shard(index, from_payload, from_value)
+
+    def scan_shard(self, index, from_payload, from_value):
+        return self._pinned(index, lambda shard: shard.data.scan(from_payload, from_value))
+
+    def peek(self, key, from_payload, from_value):
+        with self._pin(self.shard_of(key)) as shard:
+            return shard.data.peek(key, from_payload, from_value)
+
+    def mark_dirty(self, key):
+        with self._pin(self.shard_of(key)) as shard:
+            if key in shard.data.cache:
+                shard.data.mark_dirty(key)
+
+    def put(self, key, state, payload=None):
+        with self._pin(self.shard_of(key)) as shard:
+            # The record may be a copy whose shard was closed since it was read
+            if key not in shard.data.cache:
+                shard.data[key] = self.restore(state)
+            shard.journal.put(key, state, payload)
+            shard.changed = True
+
+    def delete(self, key):
+        with self._pin(self.shard_of(key)) as shard:
+            shard.journal.delete(key)
+            shard.changed = True
+
+    def save(self, snapshot_items=None):
+        # Closed shards were written back when they were closed. Every shard
+        # is saved even if one reports an error; the first is raised.
+        error = None
+        for shard in self.resident.values():
+            if shard.changed:
+                shard.changed = False
+                try:
+                    shard.journal.save(shard.data.snapshot_items, shard.data.rebase)
+                except Exception as e:
+                    error = error or e
+        if error is not None:
+            raise error
+
+    def wait(self):
+        for shard in self.resident.values():
+            shard.journal.wait()
+
+    def close(self):
+        # Like save(), every shard is closed even if one fails; a shard that
+        # failed stays open and the first error is raised
+        error = None
+        with self.lock:
+            for index, shard in list(self.resident.items()):
+                try:
+                    shard.close()
+                except Exception as e:
+                    error = error or e
+                    continue
+                self.lengths[index] = len(shard.data)
+                del self.resident[index]
+        if error is not None:
+            raise error
+
+
+def open_shards(filename, count, budget, decode, encode, restore, partition=str):
+    # A ShardedMapping for filename. A book saved unsharded at filename is
+    # split into shards first, then renamed to filename + '.unsharded'. The
+    # count is recorded in filename + '.shards' and must match from then on;
+    # None opens an already sharded book with its recorded count.
+    manifest = filename + '.shards'
+    if os.path.exists(manifest):
+        with open(manifest, encoding='utf-8') as file:
+            recorded = int(file.read())
+        if count is None:
+            count = recorded
+        if recorded != count:
+            raise ValueError(f"{filename} is split into {recorded} shards; open it with that many")
+    mapping = ShardedMapping(filename, count, budget, decode, encode, restore, partition)
+    if not os.path.exists(manifest):
+        suffixes = ('', '.journal', '.journal.old')
+        if any(os.path.exists(filename + suffix) for suffix in suffixes):
+            _split(filename, mapping)
+        with open(manifest + '.tmp', 'w', encoding='utf-8') as file:
+            file.write(str(count))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(manifest + '.tmp', manifest)
+        fsync_directory(manifest)
+        # Only now is the unsharded book out of use; its journals go with it
+        for suffix in suffixes:
+            if os.path.exists(filename + suffix):
+                os.replace(filename + suffix, f"{filename}.unsharded{suffix}")
+    return mapping
+
+
+def _split(filename, mapping):
+    # One pass to assign shards, then one pass per shard over the mapped file
+    journal = JournaledFile(filename)
+    store, legacy, entries = journal.load()
+    source = LazyMapping(decode_state, encode_state, store)
+    for key, value in legacy.items():
+        source[key] = legacy_state(value)
+    for op, key, state in entries:
+        if op == 'put':
+            source[key] = state
+        elif key in source:
+            del source[key]
+    shards = array.array('H', (mapping.shard_of(key) for key, _ in source.snapshot_items()))
+    for index in range(mapping.count):
+        IndexedFile.write(mapping.shard_path(index), (
+            item for item, shard in zip(source.snapshot_items(), shards) if shard == index
+        ))
+    source.close()
+
+
+class StorageEngine:
+    # A data directory with one segment (snapshot + journal) per kind of
+    # data, e.g. contacts.db and notes.db. Segments are opened, loaded and
+    # saved independently of each other. With shards, contacts are split
+    # over that many files and at most shard_budget bytes of them are kept
+    # open (see ShardedMapping).
+    def __init__(self, directory, shards=0, shard_budget=256 << 20):
+        self.directory = directory
+        self.shards = shards
+        self.shard_budget = shard_budget
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, segment):
+        return os.path.join(self.directory, segment + '.db')
+
+    def is_sharded(self, segment):
+        return bool(self.shards) or os.path.exists(self.path(segment) + '.shards')
+
+
+def convert_legacy(source, target):
+    legacy = load_legacy(source)
+    IndexedFile.write(target, ((key, encode_state(legacy_state(value))) for key, value in legacy.items()))
@@ -0,0 +1,40 @@
+import os
+import random
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage import JournaledFile  # noqa: E402
+
+
+@pytest.fixture
+def small_journals(monkeypatch):
+    # Compact after a few hundred bytes of journal instead of a megabyte
+    monkeypatch.setattr(JournaledFile, 'needs_compaction', lambda self: self.file.tell() > 512)
+
+
+@pytest.fixture
+def slow_writer(monkeypatch):
+    # Stretch compactions and the moment save() is entered, so a compaction
+    # regularly finishes while the caller is between two steps of a save
+    rng = random.Random(7)
+    compact, save = JournaledFile._compact, JournaledFile.save
+
+    def slow_compact(self, rotated, items):
+        def trickle():
+            for item in items:
+                time.sleep(0.0002)
+                yield item
+
+        time.sleep(rng.random() * 0.005)
+        compact(self, rotated, trickle())
+
+    def slow_save(self, *args, **kwargs):
+        time.sleep(rng.random() * 0.003)
+        return save(self, *args, **kwargs)
+
+    monkeypatch.setattr(JournaledFile, '_compact', slow_compact)
+    monkeypatch.setattr(JournaledFile, 'save', slow_save)
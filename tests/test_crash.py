@@ -0,0 +1,111 @@
+import os
+import random
+import signal
+import subprocess
+import sys
+import time
+
+import pytest
+
+from test_storage import add, contents, open_book
+
+SAVE_EVERY = 10
+
+CHILD = """
+import sys
+sys.path[:0] = {paths!r}
+from test_crash import run_child
+run_child({path!r}, {sharded!r}, {seed!r})
+"""
+
+
+def operations(seed):
+    # An endless deterministic stream of (op, name, phone) over a small set
+    # of names, replayed the same way by the child and by the model
+    rng = random.Random(seed)
+    phones = {}
+    while True:
+        name = f'N{rng.randrange(40)}'
+        phone = f'05{rng.randrange(10 ** 8):08d}'
+        if name in phones and rng.random() < 0.4:
+            del phones[name]
+            yield 'delete', name, None
+        elif name in phones:
+            yield 'edit', name, (phones[name], phone)
+            phones[name] = phone
+        else:
+            phones[name] = phone
+            yield 'add', name, phone
+
+
+def apply(book, op, name, phone):
+    if op == 'delete':
+        book.delete(name)
+    elif op == 'edit':
+        book.find(name).edit_phone(*phone)
+    else:
+        add(book, name, phone)
+
+
+def run_child(path, sharded, seed):
+    # Saves every SAVE_EVERY operations, with compactions every few saves
+    # running alongside the next operations, and prints how many operations
+    # are on disk once each save has finished
+    from storage import JournaledFile
+    JournaledFile.needs_compaction = lambda self: self.file.tell() > 512
+    book = open_book(path, sharded)
+    for count, (op, name, phone) in enumerate(operations(seed), 1):
+        apply(book, op, name, phone)
+        if count % SAVE_EVERY == 0:
+            book.journal.wait()
+            print(count - SAVE_EVERY, flush=True)
+            book.save_to_file(path)
+
+
+def models(seed, count):
+    # The expected contents after each of the first `count` operations
+    model, states = {}, [{}]
+    for op, name, phone in operations(seed):
+        if len(states) > count:
+            return states
+        if op == 'delete':
+            del model[name]
+        else:
+            model[name] = (phone[1] if op == 'edit' else phone,)
+        states.append(dict(model))
+
+
+@pytest.mark.parametrize('sharded', [False, True], ids=['unsharded', 'sharded'])
+def test_killed_process_reopens_at_a_saved_prefix(tmp_path, sharded):
+    # The child is killed at a random point, often inside a compaction; the
+    # reopened book must hold exactly the first j operations for some j no
+    # earlier than the last save it reported
+    rng = random.Random(3)
+    tests = os.path.dirname(os.path.abspath(__file__))
+    paths = [os.path.dirname(tests), tests]
+    for run in range(10):
+        path = str(tmp_path / f'book{run}.db')
+        seed = rng.randrange(1 << 30)
+        code = CHILD.format(paths=paths, path=path, sharded=sharded, seed=seed)
+        child = subprocess.Popen([sys.executable, '-c', code], stdout=subprocess.PIPE, text=True)
+        acks = rng.randrange(1, 60)
+        try:
+            for _ in range(acks):
+                saved = int(child.stdout.readline())
+            # Otherwise the kill always lands just after an ack, as the
+            # child starts its next save
+            time.sleep(rng.random() * 0.02)
+            child.send_signal(signal.SIGKILL)
+            # The child may have run on past its last ack before dying
+            for line in child.stdout:
+                saved = int(line)
+        finally:
+            child.kill()
+            child.wait()
+            child.stdout.close()
+        states = models(seed, saved + 2 * SAVE_EVERY)
+        book = open_book(path, sharded)
+        try:
+            assert contents(book) in states[saved:], (run, saved)
+        finally:
+            book.close()
@@ -0,0 +1,56 @@
+import asyncio
+import contextlib
+
+import server
+from assistant import COMMANDS, PersonalAssistant, Record
+from server import Server, open_connection, read_response
+from storage import StorageEngine
+
+
+def test_client_that_stops_reading_is_dropped(tmp_path, monkeypatch):
+    # `all` streams under the read lock; a client that takes none of it must
+    # not hold back a writer, or the readers queued behind that writer
+    monkeypatch.setattr(server, 'SEND_TIMEOUT', 0.3)
+    monkeypatch.setattr(server, 'SEND_BUFFER', 1 << 16)
+    assistant = PersonalAssistant(StorageEngine(str(tmp_path / 'data')))
+    assistant.load()
+    for i in range(50_000):
+        record = Record(f'Contact{i}')
+        record.add_phone(f'05{i:08d}')
+        assistant.address_book.add_record(record)
+    address = str(tmp_path / 'socket')
+
+    async def scenario():
+        instance = Server(assistant, COMMANDS, assistant.save, workers=2)
+        started = asyncio.get_running_loop().create_future()
+        task = asyncio.create_task(instance.run(address, started.set_result))
+        await started
+        stalled_reader, stalled = await open_connection(address)
+        await read_response(stalled_reader)
+        stalled.transport.pause_reading()
+        stalled.write(b"all\n")
+        await stalled.drain()
+        await asyncio.sleep(0.1)
+        reader, writer = await open_connection(address)
+        await read_response(reader)
+
+        async def ask(command):
+            writer.write(f"{command}\n".encode())
+            await writer.drain()
+            return await asyncio.wait_for(read_response(reader), 5)
+
+        assert await ask('add Late 0509999999') == ["Contact added."]
+        assert (await ask('phone Late'))[0].startswith("Phone number for Late")
+        # The stalled client's connection was closed under it
+        stalled.transport.resume_reading()
+        with contextlib.suppress(ConnectionError):
+            while await asyncio.wait_for(stalled_reader.read(1 << 16), 5):
+                pass
+        for connection in (writer, stalled):
+            connection.close()
+        task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await task
+
+    asyncio.run(scenario())
+    assistant.close()
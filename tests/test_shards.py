@@ -0,0 +1,46 @@
+import random
+import sys
+import threading
+
+from assistant import PersonalAssistant, handle_command
+from storage import StorageEngine
+
+
+def test_concurrent_point_lookups_while_shards_are_evicted(tmp_path):
+    # Like reads sharing the data in the server: a budget of about one shard
+    # keeps every lookup evicting the shard another thread is reading
+    assistant = PersonalAssistant(StorageEngine(str(tmp_path / 'data'), shards=16, shard_budget=1 << 10))
+    assistant.load()
+    for i in range(400):
+        handle_command(f'add N{i} 05{i:08d}', assistant)
+        handle_command(f'add-birthday N{i} {i % 28 + 1:02d}.03.1990', assistant)
+    assert handle_command('exit', assistant) == "Good bye!"
+    assistant = PersonalAssistant(StorageEngine(str(tmp_path / 'data'), shards=16, shard_budget=1 << 10))
+    assistant.load()
+    errors = []
+
+    def lookups(seed):
+        rng = random.Random(seed)
+        try:
+            for _ in range(1500):
+                i = rng.randrange(400)
+                if rng.random() < 0.5:
+                    assert handle_command(f'phone N{i}', assistant) == f"Phone number for N{i}: 05{i:08d}"
+                else:
+                    assert handle_command(f'show-birthday N{i}', assistant) == f"Birthday for N{i}: {i % 28 + 1:02d}.03.1990"
+        except BaseException as e:
+            errors.append(e)
+
+    interval = sys.getswitchinterval()
+    # Switch threads as often as possible so they interleave inside lookups
+    sys.setswitchinterval(1e-6)
+    try:
+        threads = [threading.Thread(target=lookups, args=(seed,)) for seed in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.setswitchinterval(interval)
+    assistant.close()
+    assert errors == []
@@ -0,0 +1,120 @@
+from datetime import date
+import re
+
+# Field parsers shared by assistant.py and bot.py. Each returns the canonical
+# value or raises ValueError; patterns are compiled once at import, and the
+# common input shapes are checked with str methods before any regex runs.
+
+PHONE_ERROR = "Invalid phone number format"
+EMAIL_ERROR = "Invalid email format"
+BIRTHDAY_ERROR = "Invalid birthday format. Use DD.MM.YYYY"
+
+# Phones pack into one int. Local numbers keep their 10 digits (with +38 or
+# 38 in front they are the same local number); numbers with any other
+# country code keep all 11-15 digits, which puts them at or above
+# INTERNATIONAL, so the two kinds never collide.
+PHONE_DIGITS = 10
+MAX_PHONE_DIGITS = 15
+HOME_COUNTRY_CODE = '38'
+INTERNATIONAL = 10 ** PHONE_DIGITS
+
+_EMAIL = re.compile(
+    r"[A-Za-z0-9!#$%&'*+/=?^_`{|}~-]+(?:\.[A-Za-z0-9!#$%&'*+/=?^_`{|}~-]+)*"
+    r"@(?:[A-Za-z0-9](?:[A-Za-z0-9-]{0,61}[A-Za-z0-9])?\.)+[A-Za-z]{2,63}"
+)
+
+
+def parse_phone(value):
+    if len(value) == PHONE_DIGITS and value.isdigit() and value.isascii():
+        return int(value)
+    # Chained replace beats both str.translate and re.sub on strings this short
+    digits = value.replace(' ', '').replace('-', '').replace('(', '').replace(')', '').replace('.', '').replace('/', '')
+    international = digits[:1] == '+'
+    if international:
+        digits = digits[1:]
+    if not (digits.isdigit() and digits.isascii() and len(digits) <= MAX_PHONE_DIGITS):
+        raise ValueError(PHONE_ERROR)
+    if len(digits) == len(HOME_COUNTRY_CODE) + PHONE_DIGITS and digits.startswith(HOME_COUNTRY_CODE):
+        return int(digits[len(HOME_COUNTRY_CODE):])
+    if len(digits) == PHONE_DIGITS and not international:
+        return int(digits)
+    if international and len(digits) > PHONE_DIGITS and digits[0] != '0':
+        return int(digits)
+    raise ValueError(PHONE_ERROR)
+
+
+def format_phone(number):
+    return f"{number:010d}" if number < INTERNATIONAL else f"+{number}"
+
+
+def phone_prefix_ranges(prefix):
+    # The [low, high) ranges of packed numbers whose format_phone() starts
+    # with prefix: bare digits match local numbers, '+' and digits
+    # international ones, one range per possible length
+    digits = prefix[1:] if prefix[:1] == '+' else prefix
+    if not (digits.isdigit() and digits.isascii()):
+        raise ValueError(PHONE_ERROR)
+    value = int(digits)
+    if digits == prefix:
+        if len(digits) > PHONE_DIGITS:
+            raise ValueError(PHONE_ERROR)
+        scale = 10 ** (PHONE_DIGITS - len(digits))
+        return [(value * scale, (value + 1) * scale)]
+    if len(digits) > MAX_PHONE_DIGITS:
+        raise ValueError(PHONE_ERROR)
+    if digits[0] == '0':
+        return []
+    scales = (10 ** (length - len(digits)) for length in range(max(len(digits), PHONE_DIGITS + 1), MAX_PHONE_DIGITS + 1))
+    return [(value * scale, (value + 1) * scale) for scale in scales]
+
+
+def parse_email(value):
+    # The domain is case-insensitive, so it is stored lower-cased
+    if len(value) > 254 or _EMAIL.fullmatch(value) is None:
+        raise ValueError(EMAIL_ERROR)
+    if value.islower():
+        return value
+    local, _, domain = value.rpartition('@')
+    return f"{local}@{domain.lower()}"
+
+
+# Parsed birthdays by text. There are only ~36500 distinct dates in a
+# century, so bulk loads mostly hit this and share the date objects.
+_BIRTHDAYS = {}
+BIRTHDAY_CACHE_SIZE = 100_000
+
+
+def parse_birthday(value):
+    parsed = _BIRTHDAYS.get(value)
+    if parsed is None:
+        parsed = _parse_birthday(value)
+        if len(_BIRTHDAYS) < BIRTHDAY_CACHE_SIZE:
+            _BIRTHDAYS[value] = parsed
+    return parsed
+
+
+def _parse_birthday(value):
+    # DD.MM.YYYY, checked by position instead of through strptime
+    if len(value) != 10 or value[2] != '.' or value[5] != '.' or not value.isascii():
+        raise ValueError(BIRTHDAY_ERROR)
+    day, month, year = value[:2], value[3:5], value[6:]
+    if not (day.isdigit() and month.isdigit() and year.isdigit()):
+        raise ValueError(BIRTHDAY_ERROR)
+    try:
+        return date(int(year), int(month), int(day))
+    except ValueError:
+        raise ValueError(BIRTHDAY_ERROR) from None
+
+
+BATCH_FAST_PATH = 16
+
+
+def validate_many(parse, values):
+    # Parses a batch of values with one parser and returns the parsed list,
+    # raising the first error. A large batch of plain 10-digit phones, the
+    # usual import, is checked and converted in a few C-level passes.
+    if parse is parse_phone and len(values) >= BATCH_FAST_PATH:
+        joined = ''.join(values)
+        if joined.isdigit() and joined.isascii() and set(map(len, values)) == {PHONE_DIGITS}:
+            return list(map(int, values))
+    return [parse(value) for value in values]